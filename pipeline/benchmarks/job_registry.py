@@ -0,0 +1,67 @@
+"""Dependency resolution cost against number of registered jobs.
+
+Compares the old scheme (dict of unit keys, completed jobids in a list,
+`re.match` per key) with `JobRegistry.pending_dependencies`.  Each run has
+njobs singleFrameDriver jobs, all but a fixed handful of them completed, and
+we time how long a coaddDriver unit takes to find what it is waiting for.
+
+    python benchmarks/job_registry.py
+"""
+from __future__ import print_function
+import re
+import timeit
+
+from pipeline.jobs import JobRegistry
+
+FILTERS = ("HSC-G", "HSC-R", "HSC-I", "HSC-Z", "HSC-Y")
+NPENDING = 10
+
+
+def legacy_dependent_jobids(job_ids, complete_job_ids, depends, filt):
+    # Pipeline.job_ids / complete_job_ids / _get_dependent_jobids as they were,
+    # with shard suffixes on the keys.
+    id_depends = []
+    for key, i in job_ids.items():
+        if i in complete_job_ids:
+            continue
+        for d in depends:
+            if re.match(d, key):
+                if key.startswith("{0}-{1}".format(d, filt)) or key == d:
+                    id_depends.append(i)
+    return id_depends
+
+
+def setup(njobs):
+    registry = JobRegistry()
+    job_ids = {}
+    complete_job_ids = []
+    for jobid in range(njobs):
+        filt = FILTERS[jobid % len(FILTERS)]
+        shard = jobid // len(FILTERS)
+        registry.add("singleFrameDriver", filt, jobid, shard=shard)
+        job_ids["singleFrameDriver-{0}-{1}".format(filt, shard)] = jobid
+        if jobid < njobs - NPENDING:
+            registry.mark_complete(jobid)
+            complete_job_ids.append(jobid)
+    return registry, job_ids, complete_job_ids
+
+
+def main(sizes=(10, 100, 1000, 10000, 30000, 100000)):
+    depends = ("singleFrameDriver", "mosaic")
+    print("{0:>8} {1:>14} {2:>14} {3:>18}".format("njobs", "legacy (ms)", "registry (ms)", "is_complete (us)"))
+    for n in sizes:
+        registry, job_ids, complete_job_ids = setup(n)
+        if n <= 10000:
+            number = max(1, 1000 // n)
+            t = timeit.timeit(lambda: legacy_dependent_jobids(job_ids, complete_job_ids, depends, "HSC-G"), number=number)
+            legacy = "{0:14.3f}".format(t / number * 1e3)
+        else:
+            # Quadratic; too slow to bother.
+            legacy = "{0:>14}".format("-")
+        t = timeit.timeit(lambda: registry.pending_dependencies(depends, filt="HSC-G"), number=1000)
+        lookup = timeit.timeit(lambda: registry.is_complete(n // 2), number=10000)
+        print("{0:>8} {1} {2:14.4f} {3:18.3f}".format(n, legacy, t, lookup / 10000 * 1e6))
+
+
+if __name__ == "__main__":
+    main()
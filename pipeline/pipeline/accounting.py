@@ -0,0 +1,193 @@
+"""Slurm accounting history for completed pipeline jobs.
+
+`sacct` fields for finished jobs (MaxRSS, TotalCPU, Elapsed, AllocCPUS) are
+collected into a columnar `AccountingHistory`.  From it we report CPU and
+memory efficiency by stage and filter, and
+`AccountingHistory.suggest_resources` sizes memory and tasks-per-node from
+the peaks observed in earlier runs.
+"""
+from __future__ import division, print_function
+import os, re
+import subprocess
+import logging
+import numpy as np
+import pandas as pd
+
+from .batch import read_job_log, FINAL_STATES
+from .store import ColumnStore
+
+DEFAULT_HISTORY = os.path.join(os.path.expanduser("~"), ".pipeline", "accounting.npz")
+
+SACCT_FIELDS = ("JobID", "State", "Elapsed", "TotalCPU", "AllocCPUS", "NNodes", "NTasks", "MaxRSS", "End")
+
+
+def parse_duration(s):
+    """Seconds from a slurm duration: [D-][HH:]MM:SS[.mmm]
+    """
+    if not s or s in ("INVALID", "UNLIMITED"):
+        return np.nan
+    days = 0
+    if "-" in s:
+        d, s = s.split("-")
+        days = int(d)
+    seconds = 0.0
+    for part in s.split(":"):
+        seconds = seconds * 60 + float(part)
+    return days * 86400 + seconds
+
+
+def parse_memory(s):
+    """Bytes from a slurm memory string like 1234K or 1.5G.
+    """
+    m = re.match(r"^([\d.]+)([KMGT]?)", s or "")
+    if not m:
+        return np.nan
+    scale = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}[m.group(2)]
+    return float(m.group(1)) * scale
+
+
+def get_job_accounting(jobids):
+    """Returns DataFrame of sacct accounting for jobids, one row per job.
+
+    MaxRSS and NTasks are only reported for job steps, so they are taken as the
+    maximum over all steps of each job.
+    """
+    cmd = "sacct -n -P -j {0} --format {1}".format(",".join([str(j) for j in jobids]), ",".join(SACCT_FIELDS))
+    output = subprocess.check_output(cmd, shell=True, universal_newlines=True)
+
+    jobs = {}
+    for line in output.splitlines():
+        x = dict(zip(SACCT_FIELDS, line.split("|")))
+        if "JobID" not in x:
+            continue
+        jobid = int(re.match(r"^(\d+)", x["JobID"]).group(1))
+        max_rss = parse_memory(x["MaxRSS"])
+        ntasks = int(x["NTasks"]) if x["NTasks"] else 0
+        if "." not in x["JobID"]:
+            jobs[jobid] = {
+                "jobid": jobid,
+                "state": x["State"].split()[0],
+                "elapsed": parse_duration(x["Elapsed"]),
+                "total_cpu": parse_duration(x["TotalCPU"]),
+                "alloc_cpus": int(x["AllocCPUS"] or 0),
+                "nnodes": int(x["NNodes"] or 0),
+                "ntasks": ntasks,
+                "max_rss": max_rss,
+                "end": x["End"],
+            }
+        elif jobid in jobs:
+            job = jobs[jobid]
+            if not np.isnan(max_rss) and (np.isnan(job["max_rss"]) or max_rss > job["max_rss"]):
+                job["max_rss"] = max_rss
+            job["ntasks"] = max(job["ntasks"], ntasks)
+
+    return pd.DataFrame(list(jobs.values()))
+
+
+class AccountingHistory(ColumnStore):
+    """Columnar store of accounting records for pipeline jobs.
+
+    Each record is one slurm job, labeled by pipeline name, stage and filter.
+    """
+
+    columns = (
+        ("jobid", np.int64),
+        ("pipeline", str),
+        ("stage", str),
+        ("filter", str),
+        ("state", str),
+        ("elapsed", np.float64),
+        ("total_cpu", np.float64),
+        ("alloc_cpus", np.int64),
+        ("nnodes", np.int64),
+        ("ntasks", np.int64),
+        ("max_rss", np.float64),
+        ("end", str),
+    )
+    unique = ("jobid",)
+    default_filename = DEFAULT_HISTORY
+
+    def ingest_pipeline(self, pipe):
+        """Adds accounting for all finished jobs in pipe.log not yet recorded.
+
+        Returns number of jobs added.
+        """
+        if not os.path.exists(pipe.logfile):
+            return 0
+
+        units = pipe.units()
+        jobs = {}
+        for run in read_job_log(pipe.logfile):
+            if run.test:
+                continue
+            for jobname, jobid in run.jobs:
+                if jobname in units and jobid >= 0:
+                    stage, filt, _ = units[jobname]
+                    jobs[jobid] = (stage, filt or "")
+
+        data = self.data
+        done = set(data.jobid[data.state.isin(FINAL_STATES)])
+        jobids = [j for j in jobs if j not in done]
+        if not jobids:
+            return 0
+
+        df = get_job_accounting(jobids)
+        if len(df) == 0:
+            logging.warning("No slurm accounting for {0} jobs.".format(len(jobids)))
+            return 0
+        df = df[df.state.isin(FINAL_STATES)].copy()
+        df["pipeline"] = pipe.name
+        df["stage"] = [jobs[j][0] for j in df.jobid]
+        df["filter"] = [jobs[j][1] for j in df.jobid]
+        self.append(df)
+        return len(df)
+
+    def efficiency(self, pipeline=None):
+        """CPU and memory efficiency by stage and filter
+
+        cpu_efficiency is TotalCPU / (Elapsed * AllocCPUS); peak_rss_mb is the
+        largest per-task MaxRSS seen, in MB.
+        """
+        df = self.data
+        if pipeline is not None:
+            df = df[df.pipeline == pipeline]
+        df = df.assign(
+            cpu_efficiency=df.total_cpu / (df.elapsed * df.alloc_cpus),
+            oom=(df.state == "OUT_OF_MEMORY"),
+            rss_mb=df.max_rss / (1 << 20),
+        )
+        grouped = df.groupby(["stage", "filter"])
+        return pd.DataFrame(
+            {
+                "njobs": grouped.jobid.count(),
+                "cpu_efficiency": grouped.cpu_efficiency.mean(),
+                "mean_rss_mb": grouped.rss_mb.mean(),
+                "peak_rss_mb": grouped.rss_mb.max(),
+                "n_oom": grouped.oom.sum(),
+                "mean_elapsed": grouped.elapsed.mean(),
+            }
+        )
+
+    def suggest_resources(self, stage, filt=None, pipeline=None, cores_per_node=None, mem_per_node=None, margin=1.2):
+        """Returns batch options sized from the observed memory peak
+
+        Returns dict with "mem-per-cpu" (MB) and, if node memory is known,
+        "ntasks-per-node" packed as densely as memory allows; empty if there is
+        no history for this stage/filter.  Runs of the same pipeline are used if
+        there are any, else this stage/filter from any pipeline.  Jobs that ran
+        out of memory only give a lower bound, so their peak is doubled.
+        """
+        df = self.data
+        df = df[(df.stage == stage) & (df["filter"] == (filt or ""))]
+        if pipeline is not None and (df.pipeline == pipeline).any():
+            df = df[df.pipeline == pipeline]
+        rss = np.where(df.state == "OUT_OF_MEMORY", 2 * df.max_rss, df.max_rss)
+        rss = rss[np.isfinite(rss)]
+        if len(rss) == 0 or rss.max() <= 0:
+            return {}
+
+        mem_per_task = int(np.ceil(rss.max() * margin / (1 << 20)))
+        options = {"mem-per-cpu": mem_per_task}
+        if mem_per_node is not None and cores_per_node is not None:
+            options["ntasks-per-node"] = int(max(1, min(cores_per_node, mem_per_node // mem_per_task)))
+        return options
@@ -6,16 +6,109 @@ import numpy as np
 from io import StringIO
 import pdb
 import logging
+import threading
+from collections import namedtuple
 
+# States a job can end in without succeeding, and all the states it can end
+# in; anything else (e.g. RUNNING from a lagging sacct) may still change.
+FAILED_STATES = ("FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL")
+FINAL_STATES = ("COMPLETED",) + FAILED_STATES
 
-def write_slurm_script(filename, cmd, **batch_options):
+
+def write_sentinel_cmd(dirname, jobid, state, exitcode):
+    """Shell to atomically write "<state> <exitcode>" to <dirname>/<jobid>.exit
+
+    Arguments are shell expressions.  Written to a temp file and renamed, so
+    whoever is watching never sees a partial sentinel.
+    """
+    final = "{0}/{1}.exit".format(dirname, jobid)
+    tmp = "{0}/.{1}.exit.tmp".format(dirname, jobid)
+    return 'echo "{0} {1}" > "{2}" && mv -f "{2}" "{3}"'.format(state, exitcode, tmp, final)
+
+
+def staging_cmds(root, scratch, manifest, rerun, name, streams=16, shared=False):
+    """Shell (before, after) running cmd on a staged copy of root
+
+    Before sets $STAGE_DIR under scratch and stages the inputs in manifest to
+    $STAGE_DIR/repo (see `staging`), on every node unless scratch is shared;
+    cmd should read from $STAGE_DIR/repo.  After writes the rerun back and
+    cleans up.  Outside slurm, both run once, locally.
+    """
+    # One copy per node, unless it's a shared fast tier
+    launch = "" if shared else "${SLURM_JOB_ID:+srun --ntasks-per-node=1 --ntasks=$SLURM_JOB_NUM_NODES} "
+    staging = "{0}python -m pipeline.staging {1} --root {2} --dest $STAGE_DIR/repo --rerun {3} --streams {4}"
+    before = "export STAGE_DIR={0}/{1}.${{SLURM_JOB_ID:-$$}}\n".format(scratch, name)
+    before += "{0} --manifest {1}\n".format(staging.format(launch, "stage", root, rerun, streams), manifest)
+    after = 'if [ "$status" -eq 0 ]; then\n'
+    after += "    {0}\n".format(staging.format(launch, "writeback", root, rerun, streams))
+    after += "    status=$?\n"
+    after += "fi\n"
+    after += '{0}rm -rf "$STAGE_DIR"\n'.format(launch)
+    return before, after
+
+
+def write_slurm_script(filename, cmd, sentinel_dir=None, staging=None, **batch_options):
+    """Writes sbatch script running cmd
+
+    If sentinel_dir is given, the script finishes by writing an exit-status
+    sentinel for its job there (see `sentinel.SentinelWatcher`).  If staging
+    is given, it is the keyword arguments of `staging_cmds`, and cmd runs on
+    the staged inputs.
+    """
     with open(filename, "w") as fout:
         fout.write("#!/bin/bash\n")
         for opts in batch_options.items():
             fout.write("#SBATCH --{0}={1}\n".format(*opts))
 
         fout.write("\n")
-        fout.write("{0}\n".format(cmd))
+        if staging is None:
+            fout.write("{0}\n".format(cmd))
+        else:
+            before, after = staging_cmds(**staging)
+            fout.write(before)
+            fout.write("status=$?\n")
+            fout.write('if [ "$status" -eq 0 ]; then\n')
+            fout.write("    {0}\n".format(cmd))
+            fout.write("    status=$?\n")
+            fout.write("fi\n")
+            fout.write(after)
+            fout.write("(exit $status)\n")
+
+        if sentinel_dir is not None:
+            fout.write("status=$?\n")
+            fout.write('if [ "$status" -eq 0 ]; then state=COMPLETED; else state=FAILED; fi\n')
+            fout.write("{0}\n".format(write_sentinel_cmd(sentinel_dir, "$SLURM_JOB_ID", "$state", "$status")))
+            fout.write("exit $status\n")
+
+
+def submit_sentinel_job(jobid, dirname, tries=30):
+    """Submits a tiny job that writes the sentinel for jobid once it ends.
+
+    For jobs whose batch script we don't write ourselves (ctrl_pool drivers);
+    `afterany` runs it whether the job completes, fails or is cancelled.
+    The accounting database can lag behind the job, so sacct is asked again
+    (for up to `tries` x 10 s) until it reports a final state.
+    Returns the jobid of the sentinel job.
+    """
+    state = "$(sacct -n -X -P -j {0} --format State | head -1 | cut -d\" \" -f1)".format(jobid)
+    exitcode = "$(sacct -n -X -P -j {0} --format ExitCode | head -1)".format(jobid)
+    wrap = (
+        "for i in $(seq {tries}); do state={state}; "
+        "case \"$state\" in {final}) break;; esac; sleep 10; done; "
+        "exitcode={exitcode}; {write}".format(
+            tries=tries,
+            state=state,
+            final="|".join(FINAL_STATES),
+            exitcode=exitcode,
+            write=write_sentinel_cmd(dirname, jobid, "$state", "$exitcode"),
+        )
+    )
+    cmd = (
+        "sbatch --parsable --job-name=sentinel-{0} --dependency=afterany:{0} --kill-on-invalid-dep=no "
+        "--ntasks=1 --time={1} --output=/dev/null --wrap '{2}'".format(jobid, tries // 6 + 5, wrap)
+    )
+    output = subprocess.check_output(cmd, shell=True, universal_newlines=True)
+    return int(output.strip().split(";")[0])
 
 
 def get_job_status(jobid, wait=30):
@@ -52,20 +145,110 @@ def get_job_status(jobid, wait=30):
         return status
 
 
-def get_pipeline_status(name, info=("jobid", "State", "Elapsed", "start", "end", "exitcode")):
-    pipe_logfile = os.path.join("{0}_output".format(name), "pipe.log")
+def cancel_jobs(jobids):
+    """Cancels slurm jobs with `scancel`.
+    """
+    cmd = "scancel {0}".format(" ".join([str(j) for j in jobids]))
+    subprocess.check_call(cmd, shell=True)
 
-    # Split up by ====
-    with open(pipe_logfile) as fin:
-        file_str = fin.read()
 
-    pattern = re.compile("=" * 30 + "\n" + "((\S+ \d+\n)+)")
-    m = re.findall(pattern, file_str)
+# One run recorded in pipe.log: [(jobname, jobid), ...] it submitted or
+# adopted, and whether it was a --test or --resume run.
+JobLogRun = namedtuple("JobLogRun", ("jobs", "test", "resume"))
+
+
+def read_job_log(logfile):
+    """Returns list of `JobLogRun`, one per run recorded in pipe.log
+    """
+    # Runs are a header (TEST/RESUME flags, date and the YAML) and a list of
+    # jobs, each following a line of ====.  Older logs copied the YAML in as
+    # is, so the closing ==== may follow its last line without a newline.
+    with open(logfile) as fin:
+        blocks = re.split("=" * 30 + "\n", fin.read())
+
+    runs = []
+    for header, jobs in zip(blocks[1::2], blocks[2::2]):
+        flags = header.splitlines()[:2]
+        lines = [re.match("^(\S+) (\d+)$", l) for l in jobs.splitlines()]
+        jobs = [(m.group(1), int(m.group(2))) for m in lines if m]
+        runs.append(JobLogRun(jobs, "TEST" in flags, "RESUME" in flags))
+    return runs
+
+
+class JobStatusCache(object):
+    """Slurm job states shared between many waiting stages.
+
+    Rather than every waiting stage calling `get_job_status` for each of its
+    dependencies, all job ids asked about are tracked here and refreshed
+    together with one `sacct` call at most every `interval` seconds.
+    """
+
+    def __init__(self, interval=10):
+        self.interval = interval
+        self._status = {}
+        self._last_update = 0
+        self._lock = threading.Lock()
+
+    def _query(self, jobids):
+        cmd = "sacct -n -X -P --format JobID,State -j {0}".format(",".join([str(j) for j in jobids]))
+        output = subprocess.check_output(cmd, shell=True, universal_newlines=True)
+        status = {}
+        for line in output.splitlines():
+            fields = line.split("|")
+            if len(fields) < 2 or not re.search("^\d+$", fields[0]):
+                continue
+            # e.g. "CANCELLED by 1234"
+            status[int(fields[0])] = fields[1].split()[0]
+        return status
+
+    def refresh(self):
+        with self._lock:
+            jobids = list(self._status.keys())
+            if jobids:
+                self._status.update(self._query(jobids))
+            self._last_update = time.time()
+
+    def get(self, jobid):
+        """Returns status of jobid, refreshing the whole cache if stale.
+        """
+        with self._lock:
+            known = jobid in self._status
+            if not known:
+                self._status.update(self._query([jobid]))
+                self._status.setdefault(jobid, None)
+        if time.time() - self._last_update > self.interval:
+            self.refresh()
+
+        status = self._status.get(jobid)
+        if status is None:
+            # Not in slurmdb yet; fall back to asking directly.
+            status = get_job_status(jobid)
+            with self._lock:
+                self._status[jobid] = status
+        return status
+
+    def track(self, jobids):
+        """Adds jobids to those refreshed, without querying them now
+        """
+        with self._lock:
+            for jobid in jobids:
+                self._status.setdefault(jobid, None)
+
+    def statuses(self, jobids):
+        with self._lock:
+            return {j: self._status.get(j) for j in jobids}
+
+
+def get_pipeline_status(name, info=("jobid", "State", "Elapsed", "start", "end", "exitcode")):
+    pipe_logfile = os.path.join("{0}_output".format(name), "pipe.log")
 
-    run_lists = [mm[0].splitlines() for mm in m]
     results = []
-    for run in run_lists:
-        jobs, ids = zip(*[l.split() for l in run])
+    for run in read_job_log(pipe_logfile):
+        # Test runs' jobids are made up.
+        if run.test or not run.jobs:
+            continue
+        jobs, ids = zip(*run.jobs)
+        ids = [str(i) for i in ids]
         id_str = ",".join(ids)
         info_str = ",".join(info)
 
@@ -0,0 +1,128 @@
+"""Reuse of stage outputs across reruns, keyed by `provenance.unit_hash`.
+
+Every submitted unit is recorded in an `OutputCache` under its hash, along
+with the rerun it wrote to.  When a later rerun would run a unit with the same
+hash, and the earlier job wrote a COMPLETED sentinel, the earlier outputs are
+linked into the new rerun instead (much as `MakeDiscreteSkyMapStage` links a
+precomputed skymap): directories are recreated and files symlinked.  Only the
+files a stage itself writes are linked (see `PipelineStage._output_patterns`),
+so later stages write their own, new files into real directories of the new
+rerun and never through a link into the old one.
+"""
+from __future__ import print_function
+import os
+import glob
+import time
+import shutil
+import numpy as np
+import pandas as pd
+
+from .store import ColumnStore
+from .sentinel import sentinel_path, read_sentinel
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser("~"), ".pipeline", "outputs.npz")
+
+# Files that make a rerun directory a Butler repository with the right parent.
+REPO_FILES = ("repositoryCfg.yaml", "_parent", "_mapper")
+
+
+def link_tree(src, dest):
+    """Recreates the directories under src in dest, symlinking the files
+
+    src may also be a single file.  Existing files in dest are left alone.
+    Returns number of files linked.
+    """
+    if not os.path.isdir(src):
+        if os.path.lexists(dest):
+            return 0
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        os.symlink(os.path.realpath(src), dest)
+        return 1
+    n = 0
+    for root, dirs, files in os.walk(src, followlinks=True):
+        target = os.path.join(dest, os.path.relpath(root, src))
+        if not os.path.exists(target):
+            os.makedirs(target)
+        for f in files:
+            link = os.path.join(target, f)
+            if not os.path.lexists(link):
+                os.symlink(os.path.realpath(os.path.join(root, f)), link)
+                n += 1
+    return n
+
+
+def link_outputs(stage, filt, src_rerun_dir, dest_rerun_dir):
+    """Links outputs of stage/filt from one rerun directory into another
+
+    Returns number of files linked.
+    """
+    filters = [filt] if filt is not None else list(stage.pipeline.filters)
+    n = 0
+    for pattern in stage._output_patterns:
+        for f in filters:
+            for src in glob.glob(os.path.join(src_rerun_dir, pattern.format(filter=f))):
+                dest = os.path.join(dest_rerun_dir, os.path.relpath(src, src_rerun_dir))
+                n += link_tree(src, dest)
+
+    # If no task has written to the new rerun yet, it needs the old one's repo
+    # configuration to find its parent.
+    for name in REPO_FILES:
+        src = os.path.join(src_rerun_dir, name)
+        dest = os.path.join(dest_rerun_dir, name)
+        if os.path.lexists(src) and not os.path.lexists(dest):
+            if os.path.islink(src):
+                os.symlink(os.readlink(src), dest)
+            else:
+                shutil.copy(src, dest)
+    return n
+
+
+class OutputCache(ColumnStore):
+    """Which rerun holds the outputs of each unit hash
+    """
+
+    columns = (
+        ("key", str),
+        ("stage", str),
+        ("filter", str),
+        ("shard", str),
+        ("rerun_dir", str),
+        ("output_dir", str),
+        ("jobid", np.int64),
+        ("created", np.float64),
+    )
+    unique = ("key", "rerun_dir")
+    default_filename = DEFAULT_CACHE
+
+    def record(self, key, stage, filt, shard, rerun_dir, output_dir, jobid):
+        row = {
+            "key": key,
+            "stage": stage,
+            "filter": filt or "",
+            "shard": shard or "",
+            "rerun_dir": rerun_dir,
+            "output_dir": output_dir,
+            "jobid": jobid,
+            "created": time.time(),
+        }
+        self.append(pd.DataFrame([row]))
+
+    @staticmethod
+    def _completed(row):
+        if not os.path.isdir(row.rerun_dir):
+            return False
+        filename = sentinel_path(row.output_dir, row.jobid)
+        return os.path.exists(filename) and read_sentinel(filename)[0] == "COMPLETED"
+
+    def lookup(self, key, exclude_rerun_dir=None):
+        """Most recent completed entry for key outside exclude_rerun_dir, or None
+        """
+        df = self.data
+        df = df[df.key == key]
+        if exclude_rerun_dir is not None:
+            df = df[df.rerun_dir != exclude_rerun_dir]
+        for row in df.sort_values("created", ascending=False).itertuples():
+            if self._completed(row):
+                return row
+        return None
@@ -0,0 +1,289 @@
+"""Long-running process that manages many pipelines at once.
+
+A single `PipelineDaemon` runs each submitted pipeline in its own thread, all
+sharing one `JobStatusCache` so slurm is polled once for everything that is
+waiting.  It listens on a Unix socket for newline-delimited JSON requests of
+the form ``{"cmd": "submit", "args": {...}}``; `DaemonClient` is the matching
+client used by `runPipeline.py` and `checkPipeline.py`.
+"""
+from __future__ import print_function
+import os
+import json
+import socket
+import logging
+import threading
+import traceback
+import datetime
+from multiprocessing.pool import ThreadPool
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from .pipeline import Pipeline
+from .batch import JobStatusCache
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".pipeline", "daemon.sock")
+
+
+def default_socket_path():
+    return os.getenv("PIPELINE_DAEMON_SOCKET", DEFAULT_SOCKET)
+
+
+class PipelineRun(object):
+    """A pipeline being run by the daemon, and the thread running it.
+    """
+
+    def __init__(self, pipeline, test=False):
+        self.pipeline = pipeline
+        self.test = test
+        self.state = "QUEUED"
+        self.error = None
+        self.started = None
+        self.finished = None
+        self._thread = None
+
+    def start(self, clobber=False, resume=False, auto_resources=None):
+        self.state = "SUBMITTING"
+        self.error = None
+        self.started = datetime.datetime.now()
+        self.finished = None
+        kwargs = dict(clobber=clobber, resume=resume, auto_resources=auto_resources)
+        self._thread = threading.Thread(target=self._run, kwargs=kwargs)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, clobber=False, resume=False, auto_resources=None):
+        try:
+            self.pipeline.run(
+                test=self.test,
+                clobber=clobber,
+                resume=resume,
+                pool_factory=ThreadPool,
+                auto_resources=auto_resources,
+            )
+            self.state = "SUBMITTED"
+        except Exception as e:
+            if self.pipeline.cancelled:
+                self.state = "CANCELLED"
+            else:
+                self.state = "FAILED"
+                self.error = str(e)
+                logging.error(traceback.format_exc())
+        self.finished = datetime.datetime.now()
+
+    @property
+    def active(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def track(self, status_cache):
+        """Has status_cache refresh the jobs of this run still outstanding
+        """
+        if not self.test:
+            status_cache.track([r.jobid for r in self.pipeline.jobs.incomplete() if r.jobid >= 0])
+
+    def summary(self, status_cache):
+        records = self.pipeline.jobs.snapshot()
+        outstanding = [r.jobid for r in records if not (r.complete or self.test or r.jobid < 0)]
+        # Sentinels are written as jobs end; slurm is asked about the rest.
+        statuses = status_cache.statuses(outstanding)
+        if outstanding:
+            statuses.update(self.pipeline.sentinels.states(outstanding))
+
+        jobs = {}
+        counts = {}
+        for record in records:
+            status = statuses.get(record.jobid) or record.state
+            jobs[record.key] = {"jobid": record.jobid, "status": status}
+            counts[status] = counts.get(status, 0) + 1
+
+        return {
+            "name": self.pipeline.name,
+            "filename": self.pipeline.filename,
+            "state": self.state,
+            "error": self.error,
+            "test": self.test,
+            "started": None if self.started is None else str(self.started),
+            "finished": None if self.finished is None else str(self.finished),
+            "jobs": jobs,
+            "counts": counts,
+        }
+
+
+class PipelineDaemon(object):
+    """Manages many pipelines with one shared status cache.
+    """
+
+    def __init__(self, socket_path=None, poll_interval=10):
+        if socket_path is None:
+            socket_path = default_socket_path()
+        self.socket_path = socket_path
+        self.status_cache = JobStatusCache(interval=poll_interval)
+        self.runs = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def _get_run(self, name):
+        with self._lock:
+            if name in self.runs:
+                return self.runs[name]
+            for run in self.runs.values():
+                if run.pipeline.filename == name:
+                    return run
+        raise KeyError("No pipeline named {0}.".format(name))
+
+    def submit(self, filename, test=False, clobber=False, resume=False, auto_resources=None):
+        filename = os.path.abspath(filename)
+        pipe = Pipeline(filename)
+        pipe.status_cache = self.status_cache
+
+        with self._lock:
+            if pipe.name in self.runs and self.runs[pipe.name].active:
+                raise RuntimeError("Pipeline {0} is already running.".format(pipe.name))
+            run = PipelineRun(pipe, test=test)
+            self.runs[pipe.name] = run
+
+        run.start(clobber=clobber, resume=resume, auto_resources=auto_resources)
+        return pipe.name
+
+    def status(self, name=None):
+        if name is None:
+            with self._lock:
+                runs = list(self.runs.values())
+        else:
+            runs = [self._get_run(name)]
+
+        for run in runs:
+            run.track(self.status_cache)
+        if not all([r.test for r in runs]):
+            self.status_cache.refresh()
+        return [r.summary(self.status_cache) for r in runs]
+
+    def cancel(self, name):
+        run = self._get_run(name)
+        jobids = run.pipeline.cancel(test=run.test)
+        if not run.active:
+            run.state = "CANCELLED"
+        return jobids
+
+    def resume(self, name):
+        run = self._get_run(name)
+        if run.active:
+            raise RuntimeError("Pipeline {0} is still running.".format(name))
+        run.start(resume=True)
+        return run.pipeline.name
+
+    def handle(self, request):
+        """Dispatches a request dict to the matching method.
+        """
+        commands = {"submit": self.submit, "status": self.status, "cancel": self.cancel, "resume": self.resume}
+        cmd = request.get("cmd")
+        if cmd not in commands:
+            raise ValueError("Unknown command: {0}".format(cmd))
+        return commands[cmd](**request.get("args", {}))
+
+    def serve_forever(self):
+        dirname = os.path.dirname(self.socket_path)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        if os.path.exists(self.socket_path):
+            if daemon_running(self.socket_path):
+                raise RuntimeError("Daemon already listening on {0}.".format(self.socket_path))
+            os.remove(self.socket_path)
+
+        self._server = _DaemonServer(self.socket_path, _RequestHandler)
+        self._server.pipeline_daemon = self
+        logging.info("Pipeline daemon listening on {0}".format(self.socket_path))
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.shutdown()
+
+
+class _DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line.decode("utf-8"))
+                response = {"ok": True, "result": self.server.pipeline_daemon.handle(request)}
+            except Exception as e:
+                response = {"ok": False, "error": "{0}: {1}".format(type(e).__name__, e)}
+            self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class DaemonClient(object):
+    """Talks to a running `PipelineDaemon` over its Unix socket.
+    """
+
+    def __init__(self, socket_path=None, timeout=30):
+        if socket_path is None:
+            socket_path = default_socket_path()
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def request(self, cmd, **kwargs):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall((json.dumps({"cmd": cmd, "args": kwargs}) + "\n").encode("utf-8"))
+            with sock.makefile("rb") as fin:
+                response = json.loads(fin.readline().decode("utf-8"))
+        finally:
+            sock.close()
+
+        if not response["ok"]:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def submit(self, filename, test=False, clobber=False, resume=False, auto_resources=None):
+        return self.request(
+            "submit",
+            filename=os.path.abspath(filename),
+            test=test,
+            clobber=clobber,
+            resume=resume,
+            auto_resources=auto_resources,
+        )
+
+    def status(self, name=None):
+        return self.request("status", name=name)
+
+    def cancel(self, name):
+        return self.request("cancel", name=name)
+
+    def resume(self, name):
+        return self.request("resume", name=name)
+
+
+def daemon_running(socket_path=None):
+    """True if a daemon is accepting connections on socket_path.
+    """
+    if socket_path is None:
+        socket_path = default_socket_path()
+    if not os.path.exists(socket_path):
+        return False
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
@@ -0,0 +1,73 @@
+"""In-process dataId queries against the Butler registry.
+
+Rather than running ``<task>.py ... --show data`` once per filter, the visit
+and ccd selections are resolved with `Butler.queryMetadata`, one registry
+query per filter (constrained to that filter, so only its rows are read),
+and returned as `VisitDataId` records.  Query results are cached, so later
+stages and per-job lookups don't hit the registry again.
+"""
+from __future__ import print_function
+import re
+from collections import namedtuple
+
+VisitDataId = namedtuple("VisitDataId", ("visit", "ccd", "filter"))
+
+
+def parse_id_list(s):
+    """Values in a CmdLineTask id expression, such as "1..9:2^12^20..22"
+
+    Integers and ranges come back as ints; anything else (e.g. patch "4,4")
+    is returned as a string.
+    """
+    values = []
+    for token in str(s).split("^"):
+        m = re.match(r"^(\d+)\.\.(\d+)(?::(\d+))?$", token)
+        if m:
+            start, stop, step = m.groups()
+            values += list(range(int(start), int(stop) + 1, int(step or 1)))
+        elif re.match(r"^\d+$", token):
+            values.append(int(token))
+        else:
+            values.append(token)
+    return values
+
+
+class DataIdQuery(object):
+    """Looks up dataIds for many filters from the registry, with caching.
+
+    Parameters
+    ----------
+    butler : `lsst.daf.persistence.Butler`
+        Butler for the input data repository.
+    datasetType : str
+        Dataset whose registry entries define the visit-level dataIds.
+    """
+
+    def __init__(self, butler, datasetType="raw"):
+        self.butler = butler
+        self.datasetType = datasetType
+        self._rows = {}
+
+    def _query(self, filt):
+        """(visit, ccd) of every dataset of filt in the registry
+        """
+        if filt not in self._rows:
+            self._rows[filt] = self.butler.queryMetadata(self.datasetType, ("visit", "ccd"), filter=filt)
+        return self._rows[filt]
+
+    def visits(self, selections):
+        """Returns {filter: [VisitDataId, ...]}
+
+        selections is {filter: (visit_expr, ccd_expr)}, with the id expressions
+        written as in the pipeline YAML; a ccd_expr of None selects all ccds.
+        """
+        result = {}
+        for filt, (visit_expr, ccd_expr) in selections.items():
+            visits = set(parse_id_list(visit_expr))
+            ccds = None if ccd_expr is None else set(parse_id_list(ccd_expr))
+            result[filt] = sorted(
+                VisitDataId(visit, ccd, filt)
+                for visit, ccd in self._query(filt)
+                if visit in visits and (ccds is None or ccd in ccds)
+            )
+        return result
@@ -0,0 +1,203 @@
+"""Registry of the jobs submitted by a pipeline run.
+
+Each submitted unit of work (stage, filter, shard) is a compact `JobRecord`.
+`JobRegistry` keeps hash indexes by jobid, unit, stage, filter and state, plus
+an index of the jobs still outstanding, so completion checks are O(1) and
+dependency resolution costs only as much as the number of outstanding
+dependencies, whether a run has ten jobs or tens of thousands.  The registry
+is locked, so a daemon thread can report on it while the run adds to it.
+"""
+from __future__ import print_function
+import time
+import threading
+from collections import defaultdict
+
+COMPLETED = "COMPLETED"
+SUBMITTED = "SUBMITTED"
+
+
+class JobRecord(object):
+    """One submitted job: which unit of work it is, and what it's doing
+    """
+
+    __slots__ = ("stage", "filter", "shard", "jobid", "state", "submitted", "finished")
+
+    def __init__(self, stage, filt=None, shard=None, jobid=None, state=SUBMITTED, submitted=None):
+        self.stage = stage
+        self.filter = filt
+        self.shard = shard
+        self.jobid = jobid
+        self.state = state
+        self.submitted = time.time() if submitted is None else submitted
+        self.finished = None
+
+    @property
+    def unit(self):
+        return (self.stage, self.filter, self.shard)
+
+    @property
+    def key(self):
+        """Name of the unit, as in "coaddDriver-HSC-G"
+        """
+        key = self.stage
+        if self.filter is not None:
+            key += "-{0}".format(self.filter)
+        if self.shard is not None:
+            key += "-{0}".format(self.shard)
+        return key
+
+    @property
+    def complete(self):
+        return self.state == COMPLETED
+
+    def __repr__(self):
+        return "JobRecord({0}, jobid={1}, state={2})".format(self.key, self.jobid, self.state)
+
+
+class JobRegistry(object):
+    """Jobs of a pipeline run, indexed by jobid, unit, stage, filter and state
+    """
+
+    def __init__(self):
+        self._by_jobid = {}
+        self._by_unit = {}
+        self._by_stage = defaultdict(dict)
+        self._by_filter = defaultdict(dict)
+        self._by_state = defaultdict(dict)
+        # Incomplete jobs only, by stage and by (stage, filter)
+        self._pending_by_stage = defaultdict(dict)
+        self._pending_by_stage_filter = defaultdict(dict)
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._by_unit)
+
+    def __iter__(self):
+        return iter(self.snapshot())
+
+    def __contains__(self, jobid):
+        return jobid in self._by_jobid
+
+    def snapshot(self):
+        """List of the records, taken under the lock
+        """
+        with self._lock:
+            return list(self._by_unit.values())
+
+    def add(self, stage, filt=None, jobid=None, shard=None, state=SUBMITTED):
+        """Registers a job for a unit, replacing any earlier job for that unit.
+        """
+        unit = (stage, filt, shard)
+        record = JobRecord(stage, filt, shard, jobid=jobid, state=state)
+        with self._lock:
+            if unit in self._by_unit:
+                self._remove(self._by_unit[unit])
+
+            self._by_unit[unit] = record
+            self._by_jobid[jobid] = record
+            self._by_stage[stage][unit] = record
+            self._by_filter[filt][unit] = record
+            self._by_state[state][unit] = record
+            if state == COMPLETED:
+                record.finished = record.submitted
+            else:
+                self._set_pending(record, True)
+        return record
+
+    def _set_pending(self, record, pending):
+        unit = record.unit
+        if pending:
+            self._pending_by_stage[record.stage][unit] = record
+            self._pending_by_stage_filter[(record.stage, record.filter)][unit] = record
+        else:
+            self._pending_by_stage[record.stage].pop(unit, None)
+            self._pending_by_stage_filter[(record.stage, record.filter)].pop(unit, None)
+
+    def _remove(self, record):
+        unit = record.unit
+        del self._by_unit[unit]
+        if self._by_jobid.get(record.jobid) is record:
+            del self._by_jobid[record.jobid]
+        del self._by_stage[record.stage][unit]
+        del self._by_filter[record.filter][unit]
+        del self._by_state[record.state][unit]
+        self._set_pending(record, False)
+
+    def get(self, stage, filt=None, shard=None):
+        return self._by_unit.get((stage, filt, shard))
+
+    def record(self, jobid):
+        return self._by_jobid[jobid]
+
+    def set_state(self, jobid, state):
+        with self._lock:
+            record = self._by_jobid.get(jobid)
+            if record is None or record.state == state:
+                return
+            del self._by_state[record.state][record.unit]
+            record.state = state
+            self._by_state[state][record.unit] = record
+            if state == COMPLETED:
+                record.finished = time.time()
+            self._set_pending(record, state != COMPLETED)
+
+    def mark_complete(self, jobid):
+        self.set_state(jobid, COMPLETED)
+
+    def is_complete(self, jobid):
+        record = self._by_jobid.get(jobid)
+        return record is not None and record.complete
+
+    def by_stage(self, stage):
+        with self._lock:
+            return list(self._by_stage[stage].values())
+
+    def by_filter(self, filt):
+        with self._lock:
+            return list(self._by_filter[filt].values())
+
+    def by_state(self, state):
+        with self._lock:
+            return list(self._by_state[state].values())
+
+    def incomplete(self):
+        with self._lock:
+            return [r for records in self._pending_by_stage.values() for r in records.values()]
+
+    def pending_dependencies(self, depends, filt=None):
+        """Jobids not yet complete that a unit of `filt` depending on `depends` waits for
+
+        With a filter, only jobs of the same filter (or of filter-less stages)
+        count; without one, every job of the depended-on stages does.
+        """
+        jobids = []
+        with self._lock:
+            for stage in depends:
+                if filt is None:
+                    groups = [self._pending_by_stage.get(stage, {})]
+                else:
+                    groups = [
+                        self._pending_by_stage_filter.get((stage, filt), {}),
+                        self._pending_by_stage_filter.get((stage, None), {}),
+                    ]
+                for records in groups:
+                    jobids += [r.jobid for r in records.values()]
+        return jobids
+
+    def job_ids(self):
+        """Jobids by unit key, e.g. {"coaddDriver-HSC-G": 1234}
+        """
+        return {r.key: r.jobid for r in self.snapshot()}
+
+    def state_counts(self):
+        with self._lock:
+            return {state: len(records) for state, records in self._by_state.items() if records}
@@ -7,11 +7,20 @@ import subprocess
 import time, datetime
 import multiprocessing
 import socket
+import threading
 
 from pkg_resources import resource_filename
 
 from lsst.daf.persistence import Butler
 
+from .batch import get_job_status, cancel_jobs, read_job_log
+from .accounting import AccountingHistory
+from .dataids import DataIdQuery
+from .jobs import JobRegistry
+from .sentinel import SentinelWatcher
+from .runtimes import RuntimeHistory
+from .cache import OutputCache, link_outputs
+from .provenance import unit_hash, software_hash, read_unit_hashes, write_unit_hashes
 from .stage import (
     SingleFrameDriverStage,
     MakeSkyMapStage,
@@ -22,11 +31,18 @@ from .stage import (
     VisitAnalysisStage,
     MatchVisitsStage,
     ColorAnalysisStage,
+    Shard,
+    STRAGGLER_SHARD,
+    shard_name,
 )
 
 
+def field_config_filename(field):
+    return resource_filename("pipeline", os.path.join("fields", "{}.yaml".format(field)))
+
+
 def read_field_config(field):
-    filename = resource_filename("pipeline", os.path.join("fields", "{}.yaml".format(field)))
+    filename = field_config_filename(field)
     with open(filename) as fin:
         d = yaml.load(fin)
 
@@ -43,12 +59,47 @@ class Pipeline(object):
     def __init__(self, filename):
         self.filename = filename
         self._read_yaml()
-        self.job_ids = {}
-        self.complete_job_ids = []
+        self.jobs = JobRegistry()
+
+        # Optional shared `JobStatusCache`; set by the daemon so many
+        # pipelines share one set of slurm queries.
+        self.status_cache = None
 
         self._stages = None
         self._butler = None
+        self._data_butler = None
+        self._dataid_query = None
         self._fields = None
+        self._accounting = None
+        self._sentinels = None
+        self._runtimes = None
+        self._output_cache = None
+        self._cancelled = threading.Event()
+        # (stage name, filter) of units resubmitted because their hash changed,
+        # and of those among them run with different software
+        self.invalidated = set()
+        self.new_software = set()
+        self._unit_hashes = {}
+
+    def __getstate__(self):
+        # If this pipeline is pickled, locks and the shared status cache stay
+        # with the parent process.
+        state = self.__dict__.copy()
+        state["status_cache"] = None
+        state["_sentinels"] = None
+        # Butlers are reopened on demand, never pickled.
+        state["_butler"] = None
+        state["_data_butler"] = None
+        state["_dataid_query"] = None
+        state["_cancelled"] = self._cancelled.is_set()
+        return state
+
+    def __setstate__(self, state):
+        cancelled = state.pop("_cancelled")
+        self.__dict__.update(state)
+        self._cancelled = threading.Event()
+        if cancelled:
+            self._cancelled.set()
 
     def _read_yaml(self):
         with open(self.filename) as fin:
@@ -57,6 +108,12 @@ class Pipeline(object):
         if "field" in self._dict:
             self._dict.update(read_field_config(self._dict["field"]))
 
+    @property
+    def job_ids(self):
+        """Jobids by unit key, e.g. {"coaddDriver-HSC-G": 1234}
+        """
+        return self.jobs.job_ids()
+
     def __getitem__(self, item):
         for s in self.stages:
             if s.name == item:
@@ -110,6 +167,102 @@ class Pipeline(object):
             self._butler = Butler(self.rerun_dir)
         return self._butler
 
+    @property
+    def sentinels(self):
+        """`SentinelWatcher` on output_dir, where batch jobs write their exit status
+        """
+        if self._sentinels is None:
+            self._sentinels = SentinelWatcher(self.output_dir)
+        return self._sentinels
+
+    @property
+    def reconcile_interval(self):
+        """Seconds between asking slurm about jobs that haven't written a sentinel
+        """
+        return self._dict.get("reconcile_interval", 60)
+
+    @property
+    def sentinel_jobs(self):
+        """Whether to chain a sentinel-writing job after each ctrl_pool driver job
+        """
+        return self._dict.get("sentinel_jobs", True)
+
+    @property
+    def data_butler(self):
+        """Butler on data_root; unlike `butler`, usable before the rerun exists.
+        """
+        if self._data_butler is None:
+            self._data_butler = Butler(self["data_root"])
+        return self._data_butler
+
+    @property
+    def dataid_query(self):
+        if self._dataid_query is None:
+            self._dataid_query = DataIdQuery(self.data_butler)
+        return self._dataid_query
+
+    @property
+    def accounting(self):
+        """`AccountingHistory` at the `accounting` path in the YAML, or the default.
+        """
+        if self._accounting is None:
+            self._accounting = AccountingHistory(self._dict.get("accounting"))
+        return self._accounting
+
+    @property
+    def auto_resources(self):
+        """Whether to size memory and tasks-per-node from accounting history
+        """
+        return self._dict.get("auto_resources", False)
+
+    @property
+    def runtimes(self):
+        """`RuntimeHistory` at the `runtimes` path in the YAML, or the default.
+        """
+        if self._runtimes is None:
+            self._runtimes = RuntimeHistory(self._dict.get("runtimes"))
+        return self._runtimes
+
+    @property
+    def isolate_stragglers(self):
+        """Whether to give persistently slow visits/patches their own shard
+        """
+        return self._dict.get("isolate_stragglers", False)
+
+    @property
+    def output_cache(self):
+        """`OutputCache` at the `output_cache` path in the YAML, or the default.
+        """
+        if self._output_cache is None:
+            self._output_cache = OutputCache(self._dict.get("output_cache"))
+        return self._output_cache
+
+    @property
+    def reuse_outputs(self):
+        """Whether to link in outputs of identical units from earlier reruns
+        """
+        return self._dict.get("reuse_outputs", False)
+
+    @property
+    def field_file(self):
+        """The `field` config merged into this pipeline, or None
+        """
+        if "field" not in self._dict:
+            return None
+        return field_config_filename(self._dict["field"])
+
+    @property
+    def provenance_file(self):
+        """Where the unit hash of each job is recorded
+        """
+        return os.path.join(self.output_dir, "provenance.json")
+
+    @property
+    def staging(self):
+        """`staging` options from the YAML (stages, scratch, streams, shared), or None
+        """
+        return self._dict.get("staging")
+
     @property
     def skymap(self):
         return self.butler.get("deepCoadd_skyMap")
@@ -126,6 +279,18 @@ class Pipeline(object):
             self._stages = [t(self) for t in stage_types]
         return self._stages
 
+    def units(self):
+        """(stage name, filter, shard name) of every job this pipeline could submit, by jobname
+        """
+        units = {}
+        for stage in self.stages:
+            filters = self.filters if stage.single_filter else [None]
+            for filt in filters:
+                for shard in (None, STRAGGLER_SHARD):
+                    jobname = stage.jobname(filt=filt, shard=Shard(shard, {}, 1))
+                    units[jobname] = (stage.name, filt, shard)
+        return units
+
     @property
     def commands(self):
         """List of commands.  NOT the exact same as the submit commands.
@@ -142,8 +307,165 @@ class Pipeline(object):
     def logfile(self):
         return os.path.join(self.output_dir, "pipe.log")
 
-    def run(self, test=False, parallel=True, clobber=False):
+    @property
+    def name(self):
+        return os.path.basename(self.output_dir)[: -len("_output")]
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def job_status(self, jobid):
+        """Returns slurm status of jobid, through the shared cache if there is one.
+        """
+        if self.status_cache is not None:
+            return self.status_cache.get(jobid)
+        return get_job_status(jobid)
+
+    def cancel(self, test=False):
+        """Stops submitting new jobs and cancels the ones already submitted.
+        """
+        self._cancelled.set()
+        jobids = [r.jobid for r in self.jobs.incomplete() if r.jobid >= 0]
+        if jobids and not test:
+            cancel_jobs(jobids)
+        return jobids
+
+    def _previous_job_ids(self, test=False):
+        """Job ids by jobname from the most recent run recorded in pipe.log
+
+        Runs that submitted nothing are skipped, and so are test runs (with
+        made-up jobids) unless this is a test run too.
+        """
+        if not os.path.exists(self.logfile):
+            return {}
+        runs = [run for run in read_job_log(self.logfile) if run.jobs and (test or not run.test)]
+        if not runs:
+            return {}
+        return dict(runs[-1].jobs)
+
+    def _resume_job(self, stage, filt, previous, test=False, shard=None):
+        """Adopts a job from a previous run if it is done or still queued.
+
+        Returns the adopted jobid (now in `jobs`), or None if the unit needs
+        to be resubmitted.
+        """
+        jobname = stage.jobname(filt=filt, shard=shard)
+        if jobname not in previous:
+            return None
+
+        jobid = previous[jobname]
+        if test:
+            status = "COMPLETED"
+        else:
+            try:
+                status = self.job_status(jobid)
+            except ValueError:
+                return None
+
+        if status not in ("COMPLETED", "RUNNING", "PENDING"):
+            return None
+
+        # Don't adopt a job whose settings or inputs have changed since.
+        key = unit_hash(stage, filt, shard=shard)
+        recorded = self._unit_hashes.get(jobname)
+        if recorded is not None and recorded["jobid"] == jobid and recorded["hash"] != key:
+            if status != "COMPLETED" and not test:
+                cancel_jobs([jobid])
+            self.invalidated.add((stage.name, filt))
+            if recorded.get("software") != software_hash():
+                self.new_software.add((stage.name, filt))
+            print("{0} changed since jobid {1}; resubmitting".format(jobname, jobid))
+            return None
+
+        self.jobs.add(stage.name, filt, jobid, shard=shard_name(shard), state=status)
+        with open(self.logfile, "a") as fout:
+            fout.write("{0} {1}\n".format(jobname, jobid))
+        print("{0} resumed (jobid={1}, {2})".format(jobname, jobid, status))
+        return jobid
+
+    def _reuse_unit(self, stage, filt=None, shard=None):
+        """Links in outputs of an identical unit from an earlier rerun, if there is one.
+
+        Returns True (with the unit registered as completed) if so.
+        """
+        if not (self.reuse_outputs and stage._output_patterns):
+            return False
+
+        key = unit_hash(stage, filt, shard=shard)
+        row = self.output_cache.lookup(key, exclude_rerun_dir=os.path.abspath(self.rerun_dir))
+        if row is None:
+            return False
+
+        n = link_outputs(stage, filt, row.rerun_dir, self.rerun_dir)
+        record = self.jobs.add(stage.name, filt, -1, shard=shard_name(shard), state="COMPLETED")
+        self._record_unit(stage, filt, shard, -1)
+        print("{0} reused from {1} ({2} files linked)".format(record.key, row.rerun_dir, n))
+        return True
+
+    def _record_unit(self, stage, filt, shard, jobid, test=False):
+        """Records the hash of a submitted or reused unit, and its outputs
+
+        Test runs have fake jobids, so nothing is recorded for them.
+        """
+        if test:
+            return
+        jobname = stage.jobname(filt=filt, shard=shard)
+        self._unit_hashes[jobname] = {
+            "jobid": jobid,
+            "hash": unit_hash(stage, filt, shard=shard),
+            "software": software_hash(),
+        }
+        self._record_outputs(stage, filt, shard, jobid)
+
+    def _record_outputs(self, stage, filt, shard, jobid):
+        if self.reuse_outputs and stage._output_patterns and jobid >= 0:
+            key = unit_hash(stage, filt, shard=shard)
+            self.output_cache.record(
+                key,
+                stage.name,
+                filt,
+                shard_name(shard),
+                os.path.abspath(self.rerun_dir),
+                os.path.abspath(self.output_dir),
+                jobid,
+            )
+
+    def run(
+        self,
+        test=False,
+        parallel=True,
+        clobber=False,
+        resume=False,
+        pool_factory=multiprocessing.Pool,
+        auto_resources=None,
+    ):
+        """Submits all stages, waiting on dependencies as necessary.
+
+        If `resume` is set, jobs from the last run in pipe.log that are completed
+        or still queued are adopted rather than resubmitted.  `pool_factory`
+        creates the pool of submit workers, shared by all stages; the daemon
+        passes a thread pool.  `auto_resources` overrides the YAML setting of the same name.
+        """
         # Should test to make sure Stage executables are found.
+        previous = self._previous_job_ids(test=test) if resume else {}
+        self._cancelled.clear()
+        self.invalidated = set()
+        self.new_software = set()
+        if auto_resources is not None:
+            self._dict["auto_resources"] = auto_resources
+
+        if self.auto_resources and not test:
+            try:
+                n = self.accounting.ingest_pipeline(self)
+                if n:
+                    self.accounting.save()
+            except subprocess.CalledProcessError:
+                logging.warning("Could not read slurm accounting; using requested resources.")
+
+        if self.isolate_stragglers and not test and os.path.exists(self.logfile):
+            if self.runtimes.ingest_pipeline(self):
+                self.runtimes.save()
 
         if not test:
             if os.path.exists(self.output_dir):
@@ -155,17 +477,34 @@ class Pipeline(object):
 
             shutil.copy(self.filename, self.output_dir)
 
+        self._unit_hashes = read_unit_hashes(self.provenance_file)
+
         with open(self.logfile, "a") as fout:
             fout.write("=" * 30 + "\n")
             if test:
                 fout.write("TEST\n")
+            if resume:
+                fout.write("RESUME\n")
             fout.write("{}\n".format(datetime.datetime.now()))
             with open(self.filename) as fin:
-                fout.write(fin.read())
+                config = fin.read()
+            fout.write(config)
+            if not config.endswith("\n"):
+                fout.write("\n")
             fout.write("=" * 30 + "\n")
 
-        self.job_ids = {}
-        self.complete_job_ids = []
+        self.jobs = JobRegistry()
+        # One pool of submit workers for all stages
+        pool = pool_factory(max(len(self.filters), 1)) if parallel else None
+        try:
+            self._run_stages(pool, test=test, previous=previous)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def _run_stages(self, pool, test=False, previous=None):
+        previous = previous or {}
         for stage in self.stages:
             if stage.single_filter:
                 try:
@@ -179,48 +518,131 @@ class Pipeline(object):
                 else:
                     weights = None
 
-                if parallel:
-                    pool = multiprocessing.Pool(len(filters))
-                    worker = submitWorker(stage, test=test, weights=weights)
-                    jobids = pool.map(worker, filters)
-                    keys = ["{0}-{1}".format(stage.name, f) for f in filters]
-                    for k, j in zip(keys, jobids):
-                        self.job_ids[k] = j
-                    pool.close()
-                    pool.join()
+                units = []
+                for filt in filters:
+                    for shard in stage.shards(filt):
+                        jobid = self._resume_job(stage, filt, previous, test=test, shard=shard)
+                        if jobid is None and not (not test and self._reuse_unit(stage, filt, shard)):
+                            units.append((filt, shard))
+
+                if not units:
+                    continue
+
+                if pool is not None:
+                    self._submit_parallel(stage, units, pool, test=test, weights=weights)
                 else:
-                    for filt in filters:
-                        jobid = stage.submit_job(filt, test=test)
-                        key = "{0}-{1}".format(stage.name, filt)
-                        self.job_ids[key] = jobid
-                        print("{0} launched (jobid={1})".format(key, jobid))
+                    for filt, shard in units:
+                        self._submit_unit(stage, filt, shard, test=test)
             else:
-                key = stage.name
-                jobid = stage.submit_job(test=test)
-                self.job_ids[key] = jobid
-                print("{0} launched (jobid={1})".format(key, jobid))
+                for shard in stage.shards():
+                    jobid = self._resume_job(stage, None, previous, test=test, shard=shard)
+                    if jobid is None and not (not test and self._reuse_unit(stage, None, shard)):
+                        self._submit_unit(stage, None, shard, test=test)
+
+            if not test:
+                write_unit_hashes(self.provenance_file, self._unit_hashes)
+                if self.reuse_outputs:
+                    self.output_cache.save()
+
+    def _submit_parallel(self, stage, units, pool, test=False, weights=None):
+        """Submits units of stage through pool as their dependencies complete
+
+        Waiting and rendering happen here; workers get only each unit's
+        `SubmitContext`.
+        """
+        waiting = {unit: stage._get_dependent_jobids(filt=unit[0]) for unit in units}
+        for (filt, shard), id_depends in waiting.items():
+            stage._announce_wait(filt, id_depends)
+
+        # Submissions in flight are registered as soon as they return, so
+        # that `cancel` sees them.
+        in_flight = []
+
+        def collect(block=False):
+            for item in list(in_flight):
+                (filt, shard), ctx, result = item
+                if block or result.ready():
+                    in_flight.remove(item)
+                    self._register_submitted(stage, filt, shard, ctx, result.get(), test=test)
+
+        last_reconcile = 0
+        seen = {}
+        try:
+            while waiting:
+                reconcile = time.time() - last_reconcile > self.reconcile_interval
+                outstanding = sorted(set(j for id_depends in waiting.values() for j in id_depends))
+                incomplete = set(
+                    stage._incomplete_dependencies(outstanding, test=test, reconcile=reconcile, seen=seen)
+                )
+                if reconcile:
+                    last_reconcile = time.time()
+
+                for unit in [u for u in units if u in waiting]:
+                    waiting[unit] = [j for j in waiting[unit] if j in incomplete]
+                    if waiting[unit]:
+                        continue
+                    del waiting[unit]
+                    filt, shard = unit
+                    kwargs = _unit_kwargs(stage, filt, shard, weights)
+                    ctx = stage.submit_context(filt, test=test, shard=shard, **kwargs)
+                    in_flight.append((unit, ctx, pool.apply_async(submitWorker(), (ctx,))))
+
+                collect()
+                if waiting:
+                    max_wait = 1 if in_flight else None
+                    stage._wait_for_any(
+                        sorted(incomplete),
+                        test=test,
+                        last_reconcile=last_reconcile,
+                        max_wait=max_wait,
+                        seen=seen,
+                    )
+        finally:
+            # Even if cancelled or failed, don't lose track of jobs already on their way.
+            collect(block=True)
+
+    def _submit_unit(self, stage, filt=None, shard=None, test=False):
+        """Waits for stage/filt/shard's dependencies, then submits it here
+        """
+        stage._wait_for_dependencies(filt=filt, test=test)
+        ctx = stage.submit_context(filt, test=test, shard=shard)
+        self._register_submitted(stage, filt, shard, ctx, ctx.submit(), test=test)
+
+    def _register_submitted(self, stage, filt, shard, ctx, jobid, test=False):
+        """Adds a just-submitted job to `jobs`; cancels it if the pipeline was cancelled meanwhile
+        """
+        record = self.jobs.add(stage.name, filt, jobid, shard=shard_name(shard))
+        # Registered before checking, so either this or `cancel` catches it.
+        if self.cancelled and jobid >= 0:
+            if not test:
+                cancel_jobs([jobid])
+            self.jobs.set_state(jobid, "CANCELLED")
+            print("{0} cancelled (jobid={1})".format(record.key, jobid))
+            return
+        stage.after_submit(jobid, ctx, test=test)
+        print("{0} launched (jobid={1})".format(record.key, jobid))
+        self._record_unit(stage, filt, shard, jobid, test=test)
 
     def write_script(self, filename):
         with open(filename, "w") as fout:
             fout.writelines(self.commands)
 
 
-class submitWorker(object):
-    def __init__(self, stage, weights=None, test=False):
-        self.stage = stage
-        self.test = test
-        self.weights = weights
+def _unit_kwargs(stage, filt, shard, weights=None):
+    """Cores for a unit, as its share of the stage's total_cores by filter weight
+    """
+    if weights is None:
+        return {}
+    try:
+        total_cores = stage.pipeline.kwargs[stage.name]["total_cores"]
+    except KeyError:
+        return {}
+    fraction = 1 if shard is None else shard.fraction
+    return {"cores": int(weights[filt] * fraction * total_cores)}
 
-    def __call__(self, filt):
-        time.sleep(np.random.random() * 5)
-        kwargs = dict(test=self.test)
-        if self.weights is not None:
-            try:
-                total_cores = self.stage.pipeline.kwargs[self.stage.name]["total_cores"]
-                kwargs["cores"] = int(self.weights[filt] * total_cores)
-            except KeyError:
-                pass
 
-        jobid = self.stage.submit_job(filt, **kwargs)
-        print("{0} launched for {1} (jobid={2})".format(self.stage.name, filt, jobid))
-        return jobid
+class submitWorker(object):
+    def __call__(self, ctx):
+        # Stagger submissions a little
+        time.sleep(np.random.random() * 5)
+        return ctx.submit()
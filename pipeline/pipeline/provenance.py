@@ -0,0 +1,167 @@
+"""Hashes of everything that determines the outputs of a unit of work.
+
+A unit is one (stage, filter, shard) job.  Its hash covers the stage name,
+resolved keyword arguments (less those that only affect scheduling or
+logging), id and selectId expressions, data_root, the contents of the field
+config and skymap files, the EUPS versions of the products the drivers use,
+and the hashes of the upstream units it depends on, so that a change anywhere
+upstream changes every hash downstream of it.
+
+Hashes are used to reuse outputs across reruns (`cache.OutputCache`) and,
+recorded per job in the output directory, to resume only what changed.
+"""
+import os
+import json
+import fnmatch
+import hashlib
+
+# Keyword arguments that don't change what a task writes.
+UNHASHED_KWARGS = (
+    "time",
+    "cores",
+    "nodes",
+    "procs",
+    "total_cores",
+    "mpiexec",
+    "batch-type",
+    "batch-output",
+    "batch-submit",
+    "batch-options",
+    "batch-verbose",
+    "batch-stats",
+    "job",
+    "longlog",
+    "loglevel",
+    "doraise",
+    "clobber-config",
+    "clobber-versions",
+    "clobber-output",
+)
+
+
+# EUPS products whose versions can change what the drivers write, as
+# fnmatch patterns on product names.
+SOFTWARE_PRODUCTS = (
+    "lsst_distrib",
+    "hscPipe",
+    "pipe_drivers",
+    "pipe_tasks",
+    "pipe_base",
+    "ctrl_pool",
+    "obs_subaru",
+    "obs_base",
+    "daf_persistence",
+    "daf_butlerUtils",
+    "afw",
+    "geom",
+    "skymap",
+    "ip_isr",
+    "coadd_utils",
+    "meas_*",
+    "shapelet",
+    "psfex",
+    "astrometry_net",
+    "astrometry_net_data",
+)
+
+_digests = {}
+
+
+def file_digest(filename):
+    """sha256 of a file's contents, or None if there is no such file
+    """
+    if filename is None or not os.path.exists(filename):
+        return None
+    key = (filename, os.path.getmtime(filename))
+    if key not in _digests:
+        with open(filename, "rb") as fin:
+            _digests[key] = hashlib.sha256(fin.read()).hexdigest()
+    return _digests[key]
+
+
+def read_unit_hashes(filename):
+    """{jobname: {"jobid": jobid, "hash": unit hash, "software": software hash}} recorded for a pipeline
+    """
+    if not os.path.exists(filename):
+        return {}
+    with open(filename) as fin:
+        return json.load(fin)
+
+
+def write_unit_hashes(filename, hashes):
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as fout:
+        json.dump(hashes, fout, indent=1, sort_keys=True)
+    os.rename(tmp, filename)
+
+
+def software_version():
+    """Versions of the `SOFTWARE_PRODUCTS` set up, from the SETUP_* environment variables
+    """
+    versions = []
+    for k, v in os.environ.items():
+        if not k.startswith("SETUP_"):
+            continue
+        product = v.split()[0] if v.split() else k[len("SETUP_") :].lower()
+        if any([fnmatch.fnmatch(product, p) for p in SOFTWARE_PRODUCTS]):
+            versions.append((product, v))
+    return sorted(versions)
+
+
+def software_hash():
+    """Hex digest of `software_version`
+    """
+    blob = json.dumps(software_version())
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+
+def upstream_units(stage, filt=None):
+    """(stage, filter) units of this pipeline that stage/filt depends on
+    """
+    names = [s.name for s in stage.pipeline.stages]
+    units = []
+    for d in getattr(stage, "depends", ()):
+        if d not in names:
+            continue
+        upstream = stage.pipeline[d]
+        if not upstream.single_filter:
+            units.append((upstream, None))
+        elif filt is not None and stage.single_filter:
+            units.append((upstream, filt))
+        else:
+            units += [(upstream, f) for f in stage.pipeline.filters]
+    return units
+
+
+def unit_inputs(stage, filt=None, shard=None):
+    """Everything hashed for a unit, apart from upstream hashes, as a dict
+    """
+    kws = stage.resolved_kwargs(filt)
+    skip = set(UNHASHED_KWARGS) | set(stage._kwarg_skip) | set(stage.pipeline.filters)
+    try:
+        id_str = stage.id_str(filt, shard=shard)
+    except NotImplementedError:
+        id_str = ""
+
+    inputs = {
+        "stage": stage.name,
+        "filter": filt,
+        "kwargs": {k: v for k, v in kws.items() if k not in skip},
+        "id": id_str,
+        "data_root": stage.pipeline["data_root"],
+        "field": file_digest(stage.pipeline.field_file),
+        "skymap": file_digest(stage.pipeline._dict.get("skymap")),
+        "software": software_version(),
+    }
+    if hasattr(stage, "selectId_str"):
+        inputs["selectId"] = stage.selectId_str(filt)
+    return inputs
+
+
+def unit_hash(stage, filt=None, shard=None):
+    """Hex digest identifying the outputs of stage/filt/shard
+    """
+    inputs = unit_inputs(stage, filt, shard=shard)
+    inputs["upstream"] = [unit_hash(s, f) for s, f in upstream_units(stage, filt)]
+    blob = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()
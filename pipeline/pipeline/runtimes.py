@@ -0,0 +1,187 @@
+"""Per-dataId processing times from task logs, and straggler detection.
+
+ctrl_pool drivers bracket the work on each dataId with "Start <operation>"
+and "Finished <operation>" log messages; run with ``--longlog`` these carry
+timestamps.  `parse_log` streams through a job's log (``<job>.o<jobid>`` as
+ctrl_pool names it, or ``<job>.<jobid>.log`` for scripts the pipeline writes
+itself) pairing them up, and `RuntimeHistory` keeps the resulting durations
+across runs, so that visits/CCDs or patches that are persistently much slower
+than their peers can be found and given their own shard (see
+`PipelineStage.shards`).
+"""
+from __future__ import division, print_function
+import os, re
+import ast
+import datetime
+import numpy as np
+import pandas as pd
+
+from .batch import read_job_log
+from .store import ColumnStore
+
+DEFAULT_HISTORY = os.path.join(os.path.expanduser("~"), ".pipeline", "runtimes.npz")
+
+# Log names of batch jobs: ctrl_pool's, then our own sbatch scripts'.
+LOG_NAMES = ("{job}.o{jobid}", "{job}.{jobid}.log")
+
+_LINE = re.compile(
+    r"(?P<time>\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(?:\.\d+)?)\S*\s.*?"
+    r"(?P<node>[^\s:]+:\d+): (?P<what>Start|Finished) (?P<operation>.*)$"
+)
+_DATAID = re.compile(r"\{[^{}]*\}")
+
+_ID_KEYS = (("filter", str, ""), ("visit", int, -1), ("ccd", int, -1), ("tract", int, -1), ("patch", str, ""))
+
+
+def find_job_log(dirname, jobname, jobid):
+    """Path of the log of job jobname/jobid in dirname, or None
+    """
+    for fmt in LOG_NAMES:
+        filename = os.path.join(dirname, fmt.format(job=jobname, jobid=jobid))
+        if os.path.exists(filename):
+            return filename
+    return None
+
+
+def _parse_time(s):
+    fmt = "%Y-%m-%dT%H:%M:%S.%f" if "." in s else "%Y-%m-%dT%H:%M:%S"
+    return datetime.datetime.strptime(s, fmt)
+
+
+def parse_log(lines):
+    """Yields a dict per finished operation on a dataId in a task log.
+
+    Each has the operation name (e.g. "processing"), node, start time (s since
+    epoch), duration (s), and filter/visit/ccd/tract/patch (-1 or "" if absent).
+    Lines without a `--longlog` timestamp are skipped.
+    """
+    epoch = datetime.datetime(1970, 1, 1)
+    started = {}
+    for line in lines:
+        m = _LINE.search(line)
+        if not m:
+            continue
+        key = (m.group("node"), m.group("operation").strip())
+        t = _parse_time(m.group("time"))
+        if m.group("what") == "Start":
+            started[key] = t
+            continue
+        if key not in started:
+            continue
+        start = started.pop(key)
+
+        d = _DATAID.search(key[1])
+        if not d:
+            continue
+        try:
+            dataId = ast.literal_eval(d.group(0))
+        except (ValueError, SyntaxError):
+            continue
+
+        record = {
+            "operation": key[1][: d.start()].strip(),
+            "node": key[0],
+            "start": (start - epoch).total_seconds(),
+            "duration": (t - start).total_seconds(),
+        }
+        for k, kind, default in _ID_KEYS:
+            record[k] = kind(dataId[k]) if k in dataId else default
+        yield record
+
+
+class RuntimeHistory(ColumnStore):
+    """Columnar store of per-dataId processing durations across runs
+    """
+
+    columns = (
+        ("pipeline", str),
+        ("stage", str),
+        ("jobid", np.int64),
+        ("operation", str),
+        ("node", str),
+        ("filter", str),
+        ("visit", np.int64),
+        ("ccd", np.int64),
+        ("tract", np.int64),
+        ("patch", str),
+        ("start", np.float64),
+        ("duration", np.float64),
+    )
+    unique = ("jobid", "operation", "filter", "visit", "ccd", "tract", "patch")
+    default_filename = DEFAULT_HISTORY
+
+    def ingest_log(self, filename, **labels):
+        """Parses one log file, labeling its records with e.g. pipeline, stage, jobid
+
+        Returns number of records added.
+        """
+        with open(filename) as fin:
+            df = pd.DataFrame(list(parse_log(fin)))
+        if len(df) == 0:
+            return 0
+        for k, v in labels.items():
+            df[k] = v
+        self.append(df)
+        return len(df)
+
+    def ingest_pipeline(self, pipe):
+        """Adds records from the logs of this pipeline's finished jobs not yet recorded.
+
+        A job counts as finished once it has written its sentinel.
+        """
+        units = pipe.units()
+        seen = set(self.data.jobid)
+        n = 0
+        for run in read_job_log(pipe.logfile):
+            if run.test:
+                continue
+            for jobname, jobid in run.jobs:
+                if jobname not in units or jobid in seen or jobid < 0:
+                    continue
+                if pipe.sentinels.state(jobid) is None:
+                    continue
+                logfile = find_job_log(pipe.output_dir, jobname, jobid)
+                if logfile is None:
+                    continue
+                n += self.ingest_log(logfile, pipeline=pipe.name, stage=units[jobname][0], jobid=jobid)
+                seen.add(jobid)
+        return n
+
+    def stragglers(self, stage=None, factor=3.0, min_jobs=2):
+        """Units persistently slower than typical for their stage and filter.
+
+        A unit (visit/ccd or tract/patch) is a straggler if its median duration
+        is more than `factor` times the median over all units of the same stage,
+        filter and operation, in at least `min_jobs` different jobs.
+
+        Returns DataFrame with the unit, its median duration, the typical
+        duration and the number of jobs it was seen in.
+        """
+        df = self.data
+        if stage is not None:
+            df = df[df.stage == stage]
+        if len(df) == 0:
+            return df.assign(typical=[], ratio=[], njobs=[])
+
+        group = ["stage", "filter", "operation"]
+        unit = group + ["visit", "ccd", "tract", "patch"]
+        typical = df.groupby(group).duration.median().rename("typical")
+        grouped = df.groupby(unit)
+        units = pd.DataFrame({"duration": grouped.duration.median(), "njobs": grouped.jobid.nunique()})
+        units = units.reset_index().merge(typical.reset_index(), on=group)
+        units["ratio"] = units.duration / units.typical
+        return units[(units.ratio > factor) & (units.njobs >= min_jobs)].reset_index(drop=True)
+
+    def straggler_ids(self, stage, filt=None, **kwargs):
+        """Visits and patches with stragglers for stage (and filt), for sharding
+
+        Returns {"visit": set, "patch": set}.  A straggling CCD makes its whole
+        visit a straggler, since jobs select visits.
+        """
+        df = self.stragglers(stage=stage, **kwargs)
+        if filt is not None:
+            df = df[df["filter"] == filt]
+        return {
+            "visit": set(df.visit[df.visit >= 0].astype(int)),
+            "patch": set(df.patch[df.patch != ""]),
+        }
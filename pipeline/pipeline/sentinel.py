@@ -0,0 +1,152 @@
+"""Job completion events from exit-status sentinel files.
+
+Batch scripts finish by atomically writing ``<jobid>.exit`` into the output
+directory, containing the final state and exit code (see
+`batch.write_slurm_script` and `batch.submit_sentinel_job`).  A
+`SentinelWatcher` picks these up as they appear, with inotify if the
+optional `inotify_simple` package is installed and by rescanning the
+directory otherwise, so waiting stages hear about completion or failure
+without asking slurm.
+"""
+from __future__ import print_function
+import os, re
+import time
+import logging
+import threading
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from .batch import FINAL_STATES
+
+SENTINEL_SUFFIX = ".exit"
+
+
+def sentinel_path(dirname, jobid):
+    return os.path.join(dirname, "{0}{1}".format(jobid, SENTINEL_SUFFIX))
+
+
+def read_sentinel(filename):
+    """Returns (state, exitcode) written to a sentinel file.
+    """
+    with open(filename) as fin:
+        fields = fin.read().split()
+    if not fields:
+        return None, None
+    state = fields[0]
+    exitcode = fields[1] if len(fields) > 1 else None
+    return state, exitcode
+
+
+class SentinelWatcher(object):
+    """Collects job states from sentinel files as they appear in a directory.
+
+    A background thread waits on inotify (or rescans every `poll_interval`
+    seconds without it) and wakes anyone blocked in `wait`.
+    """
+
+    def __init__(self, dirname, poll_interval=1.0):
+        self.dirname = dirname
+        self.poll_interval = poll_interval
+        self._states = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    @property
+    def use_inotify(self):
+        return INotify is not None
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+        self._scan()
+        self._thread = threading.Thread(target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _record(self, name):
+        m = re.match(r"^(\d+){0}$".format(re.escape(SENTINEL_SUFFIX)), name)
+        if not m:
+            return False
+        jobid = int(m.group(1))
+        if self._states.get(jobid) in FINAL_STATES:
+            return False
+        try:
+            state, _ = read_sentinel(os.path.join(self.dirname, name))
+        except (IOError, OSError):
+            return False
+        if state is None or state == self._states.get(jobid):
+            return False
+        self._states[jobid] = state
+        return True
+
+    def _scan(self):
+        new = False
+        for name in os.listdir(self.dirname):
+            new = self._record(name) or new
+        return new
+
+    def _notify(self):
+        with self._condition:
+            self._condition.notify_all()
+
+    def _watch(self):
+        if self.use_inotify:
+            try:
+                inotify = INotify()
+                # Sentinels are renamed into place, but accept plain writes too.
+                inotify.add_watch(self.dirname, flags.MOVED_TO | flags.CLOSE_WRITE)
+            except OSError as e:
+                logging.warning("inotify unavailable ({0}); polling {1}.".format(e, self.dirname))
+                inotify = None
+        else:
+            inotify = None
+
+        # Catch anything written between the first scan and the watch.
+        if self._scan():
+            self._notify()
+
+        while True:
+            if inotify is not None:
+                new = False
+                for event in inotify.read():
+                    new = self._record(event.name) or new
+            else:
+                time.sleep(self.poll_interval)
+                new = self._scan()
+            if new:
+                self._notify()
+
+    def state(self, jobid):
+        """Final state of jobid from its sentinel, or None if none yet
+        """
+        self._start()
+        return self._states.get(jobid)
+
+    def states(self, jobids):
+        self._start()
+        return {j: self._states[j] for j in jobids if j in self._states}
+
+    def wait(self, jobids, timeout=None, known=None):
+        """Blocks until a sentinel for any of jobids appears or changes, or timeout.
+
+        known is {jobid: state} (None if no sentinel) as the caller last saw
+        them, e.g. from `states`; a sentinel that arrived since then returns at
+        once.  Without it, sentinels already read when called don't count.
+        Returns states of those jobids known so far.
+        """
+        self._start()
+        deadline = None if timeout is None else time.time() + timeout
+        with self._condition:
+            if known is None:
+                known = {j: self._states.get(j) for j in jobids}
+            while all([self._states.get(j) == known.get(j) for j in jobids]):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+        return self.states(jobids)
@@ -7,8 +7,59 @@ import numpy as np
 import subprocess
 import time
 import multiprocessing
+import pickle
+from collections import namedtuple
 
-from .batch import write_slurm_script, get_job_status
+from .batch import write_slurm_script, get_job_status, submit_sentinel_job, FINAL_STATES, FAILED_STATES
+from .dataids import parse_id_list
+from .staging import write_manifest
+
+# Part of a stage/filter's work submitted as its own job: name (None for the
+# main shard, which keeps the unsharded jobname), id expressions replacing
+# those from the YAML, and the fraction of the unit's ids it covers.
+Shard = namedtuple("Shard", ("name", "ids", "fraction"))
+STRAGGLER_SHARD = "stragglers"
+
+
+def shard_name(shard):
+    return None if shard is None else shard.name
+
+
+def get_jobid(output, cmd=None):
+    m = re.search("batch job (\d+)", output)
+    if not m:
+        logging.error("Cannot find job id: {0}".format(output))
+        logging.error("Command submitted: {0}".format(cmd))
+        raise RuntimeError("Cannot find job id.")
+    jobid = int(m.group(1))
+    return jobid
+
+
+class SubmitContext(
+    namedtuple("SubmitContext", ("jobname", "cmd", "logfile", "batch", "sentinel"))
+):
+    """Everything needed to submit one job, rendered in the parent process
+
+    This is all that is sent to submit workers, so the stage, the pipeline and
+    its Butlers are never pickled.  `batch` is False for commands run on the
+    head node, which have no jobid, and `sentinel` is whether the job's batch
+    script writes its own sentinel.
+    """
+
+    __slots__ = ()
+
+    def submit(self):
+        """Runs the submit command and records the jobid in the log; returns jobid
+        """
+        output = subprocess.check_output(self.cmd, shell=True, universal_newlines=True)
+        jobid = get_jobid(output, self.cmd) if self.batch else -1
+        with open(self.logfile, "a") as fout:
+            fout.write("{0} {1}\n".format(self.jobname, jobid))
+        return jobid
+
+
+def _show_data(cmd):
+    return subprocess.check_output(cmd, shell=True).splitlines()
 
 
 class KwargDict(dict):
@@ -63,9 +114,21 @@ class PipelineStage(object):
     _default_kwargs = {}
     _kwarg_skip = ("total_cores",)
 
+    # The files (or directories) this stage writes in the rerun, as globs
+    # relative to the rerun directory with {filter} filled in; stages that set
+    # these can have outputs reused from earlier reruns (see cache.OutputCache).
+    # They must not match anything a later stage writes.
+    _output_patterns = ()
+    # Datasets a job reads per visit/ccd, which can be staged to scratch
+    # (see `staging`); "raw" is read from data_root, anything else from the rerun.
+    _input_datasets = ()
+    # Whether submitting prints a slurm jobid
+    _batch = True
+
     def __init__(self, pipeline):
         self.pipeline = pipeline
         self._dataIds = None
+        self.sentinel_dir = None
 
     @property
     def _id_options(self):
@@ -75,11 +138,64 @@ class PipelineStage(object):
     def default_kwargs(self):
         return self._default_kwargs
 
-    def id_str(self, filt=None):
+    def resource_options(self, filt=None):
+        """Batch options sized from accounting history, if auto_resources is on
+        """
+        if not self.pipeline.auto_resources:
+            return {}
+        return self.pipeline.accounting.suggest_resources(
+            self.name,
+            filt,
+            pipeline=self.pipeline.name,
+            cores_per_node=self.pipeline._dict.get("cores_per_node"),
+            mem_per_node=self.pipeline._dict.get("mem_per_node"),
+        )
+
+    def _resource_kwargs(self, filt=None):
+        return {}
+
+    def shards(self, filt=None):
+        """Shards to submit for filt; [None] unless stragglers are isolated.
+
+        With isolate_stragglers on, visits (or, if listed in the YAML, patches)
+        that earlier runs found to be persistent stragglers are split off into
+        their own "stragglers" shard, so they don't set the walltime of the rest.
+        """
+        if not self.pipeline.isolate_stragglers:
+            return [None]
+
+        hint = self.pipeline.runtimes.straggler_ids(self.name, filt if self.single_filter else None)
+        try:
+            id_options = self._id_options
+        except NotImplementedError:
+            return [None]
+
+        if "visit" in id_options and filt is not None:
+            key, expr = "visit", self.pipeline["visit"][filt]
+        elif "patch" in id_options and "patch" in self.pipeline._dict:
+            key, expr = "patch", self.pipeline["patch"]
+        else:
+            return [None]
+
+        ids = parse_id_list(expr)
+        slow = [i for i in ids if i in hint[key]]
+        if not slow or len(slow) == len(ids):
+            return [None]
+
+        fast = [i for i in ids if i not in hint[key]]
+        return [
+            Shard(None, {key: "^".join([str(i) for i in fast])}, len(fast) / len(ids)),
+            Shard(STRAGGLER_SHARD, {key: "^".join([str(i) for i in slow])}, len(slow) / len(ids)),
+        ]
+
+    def id_str(self, filt=None, shard=None):
+        ids = {} if shard is None else shard.ids
         s = ""
         for key in self._id_options:
             try:
-                if key == "visit":
+                if key in ids:
+                    s += "{0}={1} ".format(key, ids[key])
+                elif key == "visit":
                     s += "visit={0} ".format(self.pipeline["visit"][filt])
                 else:
                     fmt = "{0}={{0[{0}]}} ".format(key)
@@ -122,19 +238,30 @@ class PipelineStage(object):
         This returns a `CmdLineTask`-compatible keyword string for this task, 
         to be added to the id string to make the whole command line call string.
         """
+        kws = self.resolved_kwargs(filt=filt, **kwargs)
+        skip = self._kwarg_skip + tuple(self.pipeline.filters)
+        return kws.cmd_str(skip=skip)
 
+    def resolved_kwargs(self, filt=None, **kwargs):
+        """`KwargDict` of keyword arguments for this task and filter, from defaults and YAML
+        """
         kws = KwargDict(self.default_kwargs)
+        kws.update(self._resource_kwargs(filt))
         kws.update(self.pipeline["kwargs"]["all"])
         if self.name in self.pipeline["kwargs"]:
             kws.update(self.pipeline["kwargs"][self.name])
             if filt in self.pipeline["kwargs"][self.name]:
                 kws.update(self.pipeline["kwargs"][self.name][filt])
+        if (self.name, filt) in self.pipeline.invalidated:
+            # Rerunning with changed settings into the same rerun
+            kws["clobber-config"] = True
+        if (self.name, filt) in self.pipeline.new_software:
+            # ...and with different versions of the stack
+            kws["clobber-versions"] = True
         kws.update(kwargs)
+        return kws
 
-        skip = self._kwarg_skip + tuple(self.pipeline.filters)
-        return kws.cmd_str(skip=skip)
-
-    def jobname(self, filt=None):
+    def jobname(self, filt=None, shard=None):
         try:
             s = "{0}-{1}".format(self.pipeline["job"], self.name)
         except KeyError:
@@ -142,6 +269,8 @@ class PipelineStage(object):
             s = "{0}-{1}".format(job, self.name)
         if filt is not None:
             s += "-{}".format(filt)
+        if shard is not None and shard.name is not None:
+            s += "-{}".format(shard.name)
         return s
 
     def _testify_cmd_str(self, cmd):
@@ -152,10 +281,12 @@ class PipelineStage(object):
         cmd = 'echo "{0}\nbatch job {1}; sleep {2}"'.format(cmd, jobid, sleep)
         return cmd
 
-    def cmd_str(self, filt=None, test=False, **kwargs):
-        cmd = "{0}.py {1[data_root]} --rerun {1.rerun} ".format(self.name, self.pipeline)
+    def cmd_str(self, filt=None, test=False, shard=None, data_root=None, **kwargs):
+        if data_root is None:
+            data_root = self.pipeline["data_root"]
+        cmd = "{0}.py {1} --rerun {2.rerun} ".format(self.name, data_root, self.pipeline)
 
-        id_str = self.id_str(filt)
+        id_str = self.id_str(filt, shard=shard)
         if id_str:
             cmd += "--id {0} ".format(id_str)
 
@@ -170,35 +301,85 @@ class PipelineStage(object):
 
         return cmd
 
-    def submit_cmd(self, filt=None, test=False, **kwargs):
+    def submit_cmd(self, filt=None, test=False, shard=None, **kwargs):
         """
         """
-        cmd = self.cmd_str(filt, test=test, **kwargs)
+        cmd = self.cmd_str(filt, test=test, shard=shard, **kwargs)
         return cmd
 
     def _get_dependent_jobids(self, filt=None):
-        job_ids = self.pipeline.job_ids
-        id_depends = []
-        if hasattr(self, "depends"):
-            for key, i in job_ids.items():
-                # If we know it's done, then skip.
-                if i in self.pipeline.complete_job_ids:
+        if not hasattr(self, "depends"):
+            return []
+        return self.pipeline.jobs.pending_dependencies(self.depends, filt=filt)
+
+    def _incomplete_dependencies(self, id_depends, test=False, reconcile=False, seen=None):
+        """Those of id_depends not yet complete; raises if any has failed
+
+        Completion normally arrives as a sentinel file; slurm is only asked
+        (if reconcile) about jobs that have not written one with a final state
+        (e.g. killed before they could, or written while sacct lagged).  The
+        sentinel states looked at are put in seen, for `_wait_for_any`.
+        """
+        if self.pipeline.cancelled:
+            raise RuntimeError("Pipeline cancelled while {0} was waiting.".format(self.name))
+
+        if test:
+            statuses = {}
+            for jid in id_depends:
+                statuses[jid] = "COMPLETED" if np.random.random() < 0.3 else "RUNNING"
+            sentinels = {}
+        else:
+            sentinels = self.pipeline.sentinels.states(id_depends)
+            if seen is not None:
+                seen.update({jid: sentinels.get(jid) for jid in id_depends})
+            sentinels = {jid: state for jid, state in sentinels.items() if state in FINAL_STATES}
+            statuses = dict(sentinels)
+            if reconcile:
+                for jid in id_depends:
+                    if jid not in statuses:
+                        statuses[jid] = self.pipeline.job_status(jid)
+
+        completed = []
+        for jid, status in statuses.items():
+            if status in ("RUNNING", "PENDING"):
+                self.pipeline.jobs.set_state(jid, status)
+                continue
+            elif status == "COMPLETED":
+                print("jobid {0} completed. ".format(jid))
+                completed.append(jid)
+                self.pipeline.jobs.mark_complete(jid)
+            elif status in FAILED_STATES:
+                if jid not in sentinels:
+                    # slurm can briefly report a failure; make sure.
+                    time.sleep(5)
+                    status = get_job_status(jid)
+                if status in FAILED_STATES:
+                    self.pipeline.jobs.set_state(jid, status)
+                    raise RuntimeError("Unexpected status: Job {0} is {1}.".format(jid, status))
+                else:
                     continue
 
-                for d in self.depends:
-                    m = re.match(d, key)
-                    if m:
-                        if filt is not None:
-                            if key == "{0}-{1}".format(d, filt) or key == d:
-                                id_depends.append(i)
-                        else:
-                            id_depends.append(i)
-        return id_depends
+            else:
+                logging.warning("Unknown status for {0}: {1}.".format(jid, status))
 
-    def _wait_for_dependencies(self, filt=None, test=False):
-        # Make sure all dependencies are satisfied
-        id_depends = self._get_dependent_jobids(filt=filt)
+        return [jid for jid in id_depends if jid not in completed]
 
+    def _wait_for_any(self, id_depends, test=False, last_reconcile=0, max_wait=None, seen=None):
+        """Blocks until one of id_depends may have finished, or it is time to reconcile
+
+        If max_wait is given, blocks no longer than that.  seen is the sentinel
+        states `_incomplete_dependencies` last looked at, so that one written
+        since then ends the wait at once.
+        """
+        if test:
+            time.sleep(2 if max_wait is None else min(2, max_wait))
+        else:
+            timeout = max(0, self.pipeline.reconcile_interval - (time.time() - last_reconcile))
+            if max_wait is not None:
+                timeout = min(timeout, max_wait)
+            self.pipeline.sentinels.wait(id_depends, timeout=timeout, known=seen)
+
+    def _announce_wait(self, filt, id_depends):
         if len(id_depends) > 0:
             name = self.name
             if filt is not None:
@@ -206,103 +387,143 @@ class PipelineStage(object):
             msg = "{0} waiting for jobids {1}...".format(name, id_depends)
             print(msg)
 
-        while len(id_depends) > 0:
-            completed = []
-            for jid in id_depends:
-                if test:
-                    if np.random.random() < 0.3:
-                        status = "COMPLETED"
-                    else:
-                        status = "RUNNING"
-                else:
-                    status = get_job_status(jid)
-
-                if status in ("RUNNING", "PENDING"):
-                    continue
-                elif status == "COMPLETED":
-                    print("jobid {0} completed. ".format(jid))
-                    completed.append(jid)
-                    self.pipeline.complete_job_ids.append(jid)
-                elif status in ("FAILED", "CANCELLED", "TIMEOUT"):
-                    time.sleep(5)
-                    status = get_job_status(jid)
-                    if status in ("FAILED", "CANCELLED", "TIMEOUT"):
-                        raise RuntimeError("Unexpected status: Job {0} is {1}.".format(jid, status))
-                    else:
-                        continue
+    def _wait_for_dependencies(self, filt=None, test=False):
+        # Make sure all dependencies are satisfied
+        id_depends = self._get_dependent_jobids(filt=filt)
+        self._announce_wait(filt, id_depends)
 
-                else:
-                    logging.warning("Unknown status for {0}: {1}.".format(jid, status))
+        last_reconcile = 0
+        seen = {}
+        while len(id_depends) > 0:
+            reconcile = time.time() - last_reconcile > self.pipeline.reconcile_interval
+            id_depends = self._incomplete_dependencies(id_depends, test=test, reconcile=reconcile, seen=seen)
+            if reconcile:
+                last_reconcile = time.time()
+            if id_depends:
+                self._wait_for_any(id_depends, test=test, last_reconcile=last_reconcile, seen=seen)
 
-            for jid in completed:
-                id_depends.remove(jid)
-            time.sleep(2)
+    def _show_data_cmd(self, filt=None):
+        return self.cmd_str(filt) + " --show data | grep dataId"
 
     def _getDataIds(self, filt=None):
-        cmd = self.cmd_str(filt)
-        cmd += " --show data | grep dataId"
+        return _show_data(self._show_data_cmd(filt))
+
+    def _queryDataIds(self, filters):
+        """Visit-level dataIds for filters from the (cached) Butler registry queries
+        """
+        selections = {f: (self.pipeline["visit"][f], self.pipeline._dict.get("ccd")) for f in filters}
+        return self.pipeline.dataid_query.visits(selections)
 
-        lines = subprocess.check_output(cmd, shell=True).splitlines()
-        return lines
+    @property
+    def _visit_level(self):
+        try:
+            return "visit" in self._id_options
+        except NotImplementedError:
+            return False
 
     @property
     def dataIds(self):
         if self._dataIds is None:
-            if self.single_filter:
+            if self.single_filter and self._visit_level:
+                self._dataIds = self._queryDataIds(self.pipeline.filters)
+            elif self.single_filter:
                 filters = self.pipeline.filters
                 pool = multiprocessing.Pool(len(filters))
-                worker = dataIdWorker(self)
-                ids = pool.map(worker, filters)
+                ids = pool.map(_show_data, [self._show_data_cmd(f) for f in filters])
                 self._dataIds = {f: i for f, i in zip(filters, ids)}
                 pool.close()
                 pool.join()
             else:
-                self._dataIds = {None: self.getDataIds()}
+                self._dataIds = {None: self._getDataIds()}
 
         return self._dataIds
 
+    @property
+    def staged(self):
+        """Whether this stage's inputs are staged to scratch, per `staging` in the YAML
+        """
+        staging = self.pipeline.staging
+        return bool(staging and self._input_datasets and self.name in staging.get("stages", ()))
+
+    def input_ids(self, filt, shard=None):
+        """Visit-level dataIds whose inputs a job for filt (and shard) reads
+        """
+        if self.single_filter and self._visit_level:
+            ids = self.dataIds[filt]
+        else:
+            ids = self._queryDataIds([filt])[filt]
+        if shard is not None and "visit" in shard.ids:
+            visits = set(parse_id_list(shard.ids["visit"]))
+            ids = [i for i in ids if i.visit in visits]
+        return ids
+
+    def input_files(self, ids):
+        files = []
+        for datasetType in self._input_datasets:
+            butler = self.pipeline.data_butler if datasetType == "raw" else self.pipeline.butler
+            for dataId in ids:
+                files += butler.get("{0}_filename".format(datasetType), dataId._asdict())
+        return files
+
+    def write_input_manifest(self, filt=None, shard=None):
+        """Writes the list of files to stage for a job; returns (filename, dataIds)
+        """
+        ids = self.input_ids(filt, shard=shard)
+        filename = os.path.join(self.pipeline.output_dir, "{0}.inputs".format(self.jobname(filt, shard=shard)))
+        write_manifest(filename, self.input_files(ids))
+        return filename, ids
+
+    def staging_options(self, manifest, jobname):
+        """Keyword arguments for `batch.staging_cmds`
+        """
+        staging = self.pipeline.staging
+        return {
+            "root": self.pipeline["data_root"],
+            "scratch": staging.get("scratch", "/tmp"),
+            "manifest": manifest,
+            "rerun": self.pipeline.rerun,
+            "name": jobname,
+            "streams": staging.get("streams", 16),
+            "shared": staging.get("shared", False),
+        }
+
     def filterWeights(self, filters):
         total = sum([len(self.dataIds[f]) for f in filters])
         return {f: len(self.dataIds[f]) / total for f in filters}
 
-    def get_jobid(self, output):
-        m = re.search("batch job (\d+)", output)
-        if not m:
-            logging.error("Cannot find job id: {0}".format(output))
-            logging.error("Command submitted: {0}".format(cmd))
-            raise RuntimeError("Cannot find job id.")
-        jobid = int(m.group(1))
-        return jobid
+    def submit_context(self, filt=None, test=False, shard=None, **kwargs):
+        """Renders the `SubmitContext` for a job whose dependencies are done
+        """
+        jobname = self.jobname(filt=filt, shard=shard)
+        if self.pipeline.cancelled:
+            raise RuntimeError("Pipeline cancelled; not submitting {0}.".format(jobname))
+
+        self.sentinel_dir = None
+        cmd = self.submit_cmd(filt, test=test, shard=shard, **kwargs)
+        return SubmitContext(jobname, cmd, self.pipeline.logfile, self._batch, self.sentinel_dir is not None)
+
+    def after_submit(self, jobid, ctx, test=False):
+        """Called in the parent process once jobid is submitted from ctx
+        """
+        pass
 
-    def submit_job(self, filt=None, test=False, **kwargs):
+    def submit_job(self, filt=None, test=False, shard=None, **kwargs):
         """Submits job; returns jobid
         """
         self._wait_for_dependencies(filt=filt, test=test)
-
-        cmd = self.submit_cmd(filt, test=test, **kwargs)
-
-        output = subprocess.check_output(cmd, shell=True)
-        jobid = self.get_jobid(output)
-        with open(self.pipeline.logfile, "a") as fout:
-            fout.write("{0} {1}\n".format(self.jobname(filt=filt), jobid))
+        ctx = self.submit_context(filt, test=test, shard=shard, **kwargs)
+        jobid = ctx.submit()
+        self.after_submit(jobid, ctx, test=test)
         return jobid
 
 
-class dataIdWorker(object):
-    def __init__(self, stage):
-        self.stage = stage
-
-    def __call__(self, filt):
-        return self.stage._getDataIds(filt)
-
-
 class ManualBatchStage(PipelineStage):
     _default_time = 1200
     _override_batch_options = {}
     _kwarg_skip = ("time",)
 
-    def write_batch_script(self, filt=None, test=False, **kwargs):
-        jobname = self.jobname(filt)
+    def write_batch_script(self, filt=None, test=False, shard=None, **kwargs):
+        jobname = self.jobname(filt, shard=shard)
         batchdir = self.pipeline.output_dir
         if not os.path.exists(batchdir):
             os.makedirs(batchdir)
@@ -323,37 +544,137 @@ class ManualBatchStage(PipelineStage):
             "nodes": 1,
             "ntasks-per-node": self.pipeline["cores_per_node"],
         }
+        batch_options = dict(batch_options, **self.resource_options(filt))
         batch_options = dict(batch_options, **self._override_batch_options)
         batch_options = dict(batch_options, **kwargs)
 
-        write_slurm_script(filename, self.cmd_str(filt=filt, test=test), **batch_options)
+        cmd = self.cmd_str(filt=filt, test=test, shard=shard)
+        write_slurm_script(filename, cmd, sentinel_dir=batchdir, **batch_options)
 
         self.batchfile = filename
         self.logfile = batch_options["output"]
+        self.sentinel_dir = batchdir
         return filename
 
-    def submit_cmd(self, filt=None, test=False):
-        batchfile = self.write_batch_script(filt, test=test)
+    def submit_cmd(self, filt=None, test=False, shard=None):
+        batchfile = self.write_batch_script(filt, test=test, shard=shard)
         cmd = "sbatch {0} ".format(batchfile)
         return cmd
 
 
 class HeadNodeStage(PipelineStage):
-    def get_jobid(self, output):
-        return -1
+    _batch = False
 
 
 class BatchStage(PipelineStage):
+    # Allowance for staging in and out, in minutes, on top of the processing time
+    _staging_time = 15
+
     @property
     def _default_kwargs(self):
         kws = {"mpiexec": "-bind-to socket", "batch-type": self.batch_type}
 
         kws["batch-output"] = self.pipeline.output_dir
+        # Timestamped log lines, for per-dataId runtimes (see runtimes.parse_log)
+        kws["longlog"] = True
+        return kws
+
+    def _resource_kwargs(self, filt=None):
+        # ctrl_pool drivers take processes per node as --procs, and extra sbatch
+        # arguments through --batch-submit.
+        resources = self.resource_options(filt)
+        kws = {}
+        if "ntasks-per-node" in resources:
+            kws["procs"] = resources["ntasks-per-node"]
+        if "mem-per-cpu" in resources:
+            kws["batch-submit"] = "--mem-per-cpu={0}".format(resources["mem-per-cpu"])
         return kws
 
-    def cmd_str(self, filt=None, test=False, **kwargs):
-        cmd = super(BatchStage, self).cmd_str(filt=filt, test=False, **kwargs)
-        cmd += "--job {0} ".format(self.jobname(filt))
+    def job_size(self, filt=None, **kwargs):
+        """(nodes, processes per node, cores) of a job, as ctrl_pool works them out
+        """
+        kws = self.resolved_kwargs(filt, **kwargs)
+        procs = kws.get("procs", self.pipeline["cores_per_node"])
+        if kws.get("nodes"):
+            nodes = kws["nodes"]
+            cores = nodes * procs
+        else:
+            cores = kws.get("cores", procs)
+            nodes = int(np.ceil(cores / procs))
+        return nodes, procs, cores
+
+    def _walltime_units(self, filt, shard, ids):
+        """Number of units of work `time` is given for, as ctrl_pool counts them
+
+        The driver's `time` is per dataId for singleFrameDriver.
+        """
+        return len(ids)
+
+    def write_staged_script(self, filt=None, shard=None, **kwargs):
+        """Writes our own sbatch script running the driver on staged inputs
+
+        ctrl_pool's batch scripts can't stage, so the driver is run under
+        mpiexec with --batch-type=none inside a script like those of
+        `ManualBatchStage`, sized as ctrl_pool would size it.
+        """
+        jobname = self.jobname(filt, shard=shard)
+        batchdir = self.pipeline.output_dir
+        if not os.path.exists(batchdir):
+            os.makedirs(batchdir)
+        filename = os.path.join(batchdir, "{0}.sh".format(jobname))
+
+        manifest, ids = self.write_input_manifest(filt, shard=shard)
+        kws = self.resolved_kwargs(filt, **kwargs)
+        nodes, procs, cores = self.job_size(filt, **kwargs)
+        units = self._walltime_units(filt, shard, ids)
+        time = kws.get("time", 1200) * max(units, 1) / cores / 60 + self._staging_time
+
+        batch_options = {
+            "job-name": jobname,
+            "output": "{0}/{1}.%j.log".format(batchdir, jobname),
+            "time": int(max(time, 65)),
+            "nodes": nodes,
+            "ntasks-per-node": procs,
+        }
+        batch_options = dict(batch_options, **self.resource_options(filt))
+
+        kwargs = dict(kwargs, **{"batch-type": "none"})
+        cmd = self.cmd_str(filt, shard=shard, data_root="$STAGE_DIR/repo", **kwargs)
+        cmd = "mpiexec {0} {1}".format(kws.get("mpiexec", ""), cmd)
+        staging = self.staging_options(manifest, jobname)
+        write_slurm_script(filename, cmd, sentinel_dir=batchdir, staging=staging, **batch_options)
+
+        self.batchfile = filename
+        self.logfile = batch_options["output"]
+        self.sentinel_dir = batchdir
+        return filename
+
+    def submit_cmd(self, filt=None, test=False, shard=None, **kwargs):
+        if self.staged and not test:
+            nodes = self.job_size(filt, **kwargs)[0]
+            if nodes == 1 or self.pipeline.staging.get("shared", False):
+                return "sbatch {0} ".format(self.write_staged_script(filt, shard=shard, **kwargs))
+            # Each node would read all of the job's inputs from data_root.
+            logging.warning(
+                "Not staging {0}: it runs on {1} nodes and staging scratch isn't shared.".format(
+                    self.jobname(filt, shard=shard), nodes
+                )
+            )
+        return super(BatchStage, self).submit_cmd(filt, test=test, shard=shard, **kwargs)
+
+    def after_submit(self, jobid, ctx, test=False):
+        # ctrl_pool writes the batch script, so we can't have it write its own
+        # sentinel; a small dependent job does it instead.  Staged jobs run
+        # our own script, which writes one.
+        if not test and not ctx.sentinel and self.pipeline.sentinel_jobs:
+            try:
+                submit_sentinel_job(jobid, self.pipeline.output_dir)
+            except subprocess.CalledProcessError:
+                logging.warning("Could not submit sentinel job for {0}; will poll slurm.".format(jobid))
+
+    def cmd_str(self, filt=None, test=False, shard=None, data_root=None, **kwargs):
+        cmd = super(BatchStage, self).cmd_str(filt=filt, test=False, shard=shard, data_root=data_root, **kwargs)
+        cmd += "--job {0} ".format(self.jobname(filt, shard=shard))
 
         if test:
             cmd = self._testify_cmd_str(cmd)
@@ -364,6 +685,13 @@ class BatchStage(PipelineStage):
 
 class SingleFrameDriverStage(BatchStage):
     name = "singleFrameDriver"
+    # corr/<tract>/ holds meas_mosaic's wcs-*/fcr-* outputs, not ours
+    _output_patterns = (
+        "[0-9][0-9][0-9][0-9][0-9]/{filter}/corr/*.fits",
+        "[0-9][0-9][0-9][0-9][0-9]/{filter}/output/*.fits",
+        "[0-9][0-9][0-9][0-9][0-9]/{filter}/processCcd_metadata",
+    )
+    _input_datasets = ("raw",)
     id_str_fmt = "ccd={0[ccd]} "
     single_filter = True
     _id_options = ("ccd", "visit")
@@ -373,7 +701,7 @@ class MakeSkyMapStage(ManualBatchStage):
     name = "makeSkyMap"
     _override_batch_options = {"ntasks-per-node": 1}
 
-    def id_str(self, filter=None):
+    def id_str(self, filter=None, shard=None):
         return ""
 
 
@@ -395,7 +723,7 @@ class MakeDiscreteSkyMapStage(ManualBatchStage):
         else:
             return super(MakeDiscreteSkyMapStage, self)._add_dependency(cmd, ids)
 
-    def cmd_str(self, filt=None, test=False):
+    def cmd_str(self, filt=None, test=False, shard=None):
         skymap_file = self.skymap
         if skymap_file is None:
             raise ValueError(
@@ -416,8 +744,8 @@ class MosaicStage(ManualBatchStage):
     def diagDir(self, filt):
         return os.path.join(os.path.expanduser("~"), "mosaicDiag", self.pipeline.rerun, filt)
 
-    def cmd_str(self, filt=None, test=False):
-        cmd = super(MosaicStage, self).cmd_str(filt=filt, test=test)
+    def cmd_str(self, filt=None, test=False, shard=None):
+        cmd = super(MosaicStage, self).cmd_str(filt=filt, test=test, shard=shard)
         try:
             if self.pipeline["kwargs"]["mosaic"]["diagnostics"]:
                 cmd += "--diagDir {0} ".format(self.diagDir(filt))
@@ -429,10 +757,48 @@ class MosaicStage(ManualBatchStage):
 
 class CoaddDriverStage(BatchStage):
     name = "coaddDriver"
+    # Coadds and warps, then detectCoaddSources outputs; multiBandDriver writes
+    # its own files into the same patch directories.
+    _output_patterns = (
+        "deepCoadd/{filter}/*/*",
+        "deepCoadd-results/{filter}/*/*/det-*",
+        "deepCoadd-results/{filter}/*/*/bkgd-*",
+        "deepCoadd-results/{filter}/*/*/calexp-*",
+    )
+    _input_datasets = ("calexp",)
     _id_options = ("tract", "patch")
     depends = ("singleFrameDriver", "mosaic")
     single_filter = True
 
+    def _walltime_units(self, filt, shard, ids):
+        """Number of patches; coaddDriver's `time` is per patch, not per input
+        """
+        ids = {} if shard is None else shard.ids
+        tracts = parse_id_list(ids.get("tract", self.pipeline["tract"]))
+        patches = ids.get("patch", self.pipeline._dict.get("patch"))
+        if patches is not None:
+            return len(tracts) * len(parse_id_list(patches))
+
+        try:
+            skymap = self.pipeline.skymap
+        except Exception:
+            # Not in the rerun until makeDiscreteSkyMap has run
+            try:
+                with open(self.pipeline["skymap"], "rb") as fin:
+                    skymap = pickle.load(fin)
+            except Exception as e:
+                logging.warning(
+                    "Cannot read skymap to count patches for {0} ({1}); assuming one per core.".format(
+                        self.jobname(filt, shard=shard), e
+                    )
+                )
+                return self.job_size(filt)[2]
+        n = 0
+        for tract in tracts:
+            num = skymap[tract].getNumPatches()
+            n += num[0] * num[1]
+        return n
+
     def selectId_str(self, filt=None):
         s = "ccd={0[ccd]} ".format(self.pipeline)
         s += "filter={0} ".format(filt)
@@ -442,12 +808,17 @@ class CoaddDriverStage(BatchStage):
 
 class MultiBandDriverStage(BatchStage):
     name = "multiBandDriver"
+    _output_patterns = (
+        "deepCoadd-results/merged",
+        "deepCoadd-results/{filter}/*/*/meas-*",
+        "deepCoadd-results/{filter}/*/*/forced_src-*",
+    )
     depends = ("coaddDriver",)
     _id_options = ("tract", "patch")
 
-    def id_str(self, filt=None):
+    def id_str(self, filt=None, shard=None):
         all_filters = "^".join(self.pipeline.filters)
-        return super(MultiBandDriverStage, self).id_str(filt=all_filters)
+        return super(MultiBandDriverStage, self).id_str(filt=all_filters, shard=shard)
 
 
 class CoaddAnalysisStage(ManualBatchStage):
@@ -463,8 +834,8 @@ class VisitAnalysisStage(ManualBatchStage):
     _id_options = ("visit",)
     single_filter = True
 
-    def cmd_str(self, filt=None, test=False):
-        cmd = super().cmd_str(filt=filt, test=test)
+    def cmd_str(self, filt=None, test=False, shard=None):
+        cmd = super().cmd_str(filt=filt, test=test, shard=shard)
         cmd += "--tract {}".format(self.pipeline._dict["tract"])
         return cmd
 
@@ -481,6 +852,6 @@ class ColorAnalysisStage(ManualBatchStage):
     depends = ("multiBandDriver",)
     _id_options = ("tract", "patch")
 
-    def id_str(self, filt=None):
+    def id_str(self, filt=None, shard=None):
         all_filters = "^".join(self.pipeline.filters)
-        return super(HscColorAnalysisStage, self).id_str(filt=all_filters)
+        return super(HscColorAnalysisStage, self).id_str(filt=all_filters, shard=shard)
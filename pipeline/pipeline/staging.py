@@ -0,0 +1,204 @@
+"""Pre-staging of job inputs to node-local scratch.
+
+A staged job runs its task on an overlay of the data repository built in
+scratch: the directories leading to the job's input files are real, the
+inputs themselves are copied in (many files at a time), and everything else
+is a symlink back to the shared repository.  When the task is done, the
+files it wrote into the overlay's rerun are copied back in bulk.
+
+The batch scripts run this module on each node::
+
+    python -m pipeline.staging stage --root /datasets/hsc/repo --dest $STAGE_DIR/repo --manifest job.inputs
+    python -m pipeline.staging writeback --root /datasets/hsc/repo --dest $STAGE_DIR/repo --rerun my/rerun
+
+Nothing here needs slurm; any local directory will do for --dest.
+"""
+from __future__ import print_function
+import os
+import sys
+import shutil
+import logging
+import argparse
+from multiprocessing.pool import ThreadPool
+
+REPO_CFG = "repositoryCfg.yaml"
+# Written when staging; files in the overlay older than this are inputs.
+STAMP = ".staged"
+
+
+def read_manifest(filename, root):
+    """Paths (relative to root) of the input files listed in a manifest
+
+    Files that are not under root are skipped; they will be read in place.
+    So are files that don't exist, such as calexps of CCDs that failed.
+    """
+    root = os.path.realpath(root)
+    files = []
+    missing = 0
+    with open(filename) as fin:
+        for line in fin:
+            path = line.strip()
+            if not path:
+                continue
+            if not os.path.exists(path):
+                missing += 1
+                continue
+            rel = os.path.relpath(os.path.realpath(path), root)
+            if rel.startswith(os.pardir):
+                logging.warning("Not staging {0}: not under {1}".format(path, root))
+                continue
+            files.append(rel)
+    if missing:
+        logging.warning("Not staging {0} files in {1} that don't exist".format(missing, filename))
+    return files
+
+
+def write_manifest(filename, paths):
+    with open(filename, "w") as fout:
+        for path in paths:
+            fout.write("{0}\n".format(path))
+
+
+def build_overlay(root, dest, files, dirs=()):
+    """Mirrors root at dest, with real directories only on the way to files
+
+    Everything else is symlinked to root; files themselves are left for
+    `copy_files`.  Directories in dirs (relative to root, and which need not
+    exist yet) are made real too, so that whatever is written into them stays
+    in scratch.
+    """
+    files = set(files)
+    wanted = [os.path.join(d, "") for d in dirs] + list(files)
+    dirs = set()
+    for rel in wanted:
+        d = os.path.dirname(rel)
+        while d and d not in dirs:
+            dirs.add(d)
+            d = os.path.dirname(d)
+
+    def mirror(reldir):
+        target = os.path.join(dest, reldir)
+        if not os.path.exists(target):
+            os.makedirs(target)
+        source = os.path.join(root, reldir)
+        names = os.listdir(source) if os.path.isdir(source) else []
+        names += [os.path.basename(d) for d in dirs if os.path.dirname(d) == reldir]
+        for name in set(names):
+            rel = os.path.join(reldir, name)
+            if rel in dirs:
+                mirror(rel)
+            elif rel not in files and not os.path.lexists(os.path.join(dest, rel)):
+                os.symlink(os.path.join(root, rel), os.path.join(dest, rel))
+
+    mirror("")
+
+
+def _copy(args):
+    src, dest = args
+    dirname = os.path.dirname(dest)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # Another stream made it first.
+            pass
+    shutil.copy2(src, dest)
+
+
+def copy_files(pairs, streams=16):
+    """Copies (src, dest) pairs with `streams` copies in flight
+    """
+    pool = ThreadPool(streams)
+    try:
+        pool.map(_copy, pairs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def stage(root, dest, manifest, rerun=None, streams=16):
+    """Builds the overlay at dest and copies in the inputs listed in manifest
+
+    The rerun's directory is kept real so the task's outputs land in scratch.
+    Returns number of files copied.
+    """
+    root = os.path.realpath(root)
+    files = read_manifest(manifest, root)
+    dirs = [] if rerun is None else [os.path.join("rerun", rerun)]
+    build_overlay(root, dest, files, dirs=dirs)
+
+    # An existing rerun's config names root as its parent; the task must see
+    # the overlay there instead.
+    if rerun is not None:
+        cfg = os.path.join(dest, "rerun", rerun, REPO_CFG)
+        if os.path.islink(cfg):
+            with open(cfg) as fin:
+                text = fin.read().replace(root, os.path.abspath(dest))
+            os.remove(cfg)
+            with open(cfg, "w") as fout:
+                fout.write(text)
+
+    with open(os.path.join(dest, STAMP), "w"):
+        pass
+    copy_files([(os.path.join(root, f), os.path.join(dest, f)) for f in files], streams=streams)
+    return len(files)
+
+
+def write_back(root, dest, rerun, streams=16):
+    """Copies files the task wrote into the overlay's rerun back to the real one
+
+    Symlinked directories were written through to root already, and staged
+    inputs (anything older than the staging stamp) are not copied.
+    A new rerun's repository config has its staged paths pointed back at root.
+
+    Returns number of files copied.
+    """
+    root = os.path.realpath(root)
+    staged = os.path.join(dest, "rerun", rerun)
+    real = os.path.join(root, "rerun", rerun)
+    if not os.path.isdir(staged):
+        return 0
+
+    started = os.path.getmtime(os.path.join(dest, STAMP))
+    pairs = []
+    for dirpath, dirnames, filenames in os.walk(staged):
+        for name in filenames:
+            src = os.path.join(dirpath, name)
+            if os.path.islink(src) or os.path.getmtime(src) < started:
+                continue
+            target = os.path.join(real, os.path.relpath(src, staged))
+            if name == REPO_CFG and os.path.relpath(dirpath, staged) == os.curdir:
+                if not os.path.exists(target):
+                    if not os.path.exists(real):
+                        os.makedirs(real)
+                    with open(src) as fin:
+                        cfg = fin.read().replace(os.path.abspath(dest), root)
+                    with open(target, "w") as fout:
+                        fout.write(cfg)
+                continue
+            pairs.append((src, target))
+
+    copy_files(pairs, streams=streams)
+    return len(pairs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser("Stage job inputs to scratch, or write outputs back")
+    parser.add_argument("action", choices=("stage", "writeback"))
+    parser.add_argument("--root", required=True, help="shared data repository")
+    parser.add_argument("--dest", required=True, help="overlay repository in scratch")
+    parser.add_argument("--manifest", help="file listing input paths (stage)")
+    parser.add_argument("--rerun", help="rerun the task writes to")
+    parser.add_argument("--streams", type=int, default=16, help="parallel copies")
+    args = parser.parse_args(argv)
+
+    if args.action == "stage":
+        n = stage(args.root, args.dest, args.manifest, rerun=args.rerun, streams=args.streams)
+        print("Staged {0} files to {1}".format(n, args.dest))
+    else:
+        n = write_back(args.root, args.dest, args.rerun, streams=args.streams)
+        print("Wrote back {0} files from {1}".format(n, args.dest))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,60 @@
+"""Small columnar history stores.
+
+A `ColumnStore` keeps records as one numpy array per column in an ``.npz``
+file, and hands them out as a pandas DataFrame.
+"""
+import os
+import numpy as np
+import pandas as pd
+
+
+class ColumnStore(object):
+    """Base class for npz-backed column stores
+
+    Subclasses set `columns` (sequence of (name, dtype)), `unique` (columns
+    identifying a record; a later record replaces an earlier one) and
+    `default_filename`.
+    """
+
+    columns = ()
+    unique = ()
+    default_filename = None
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = self.default_filename
+        self.filename = filename
+        self._data = None
+
+    def _load(self):
+        if os.path.exists(self.filename):
+            with np.load(self.filename) as f:
+                return pd.DataFrame({c: f[c] for c, _ in self.columns})
+        return pd.DataFrame({c: np.array([], dtype=t) for c, t in self.columns})
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = self._load()
+        return self._data
+
+    def save(self, merge=True):
+        """Writes the store; with merge, records others saved meanwhile are kept.
+        """
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        if merge:
+            self._data = self._combine(self._load(), self.data)
+        arrays = {c: np.asarray(self.data[c].values, dtype=t) for c, t in self.columns}
+        # np.savez appends .npz unless it's already there.
+        np.savez_compressed(self.filename, **arrays)
+
+    def _combine(self, first, second):
+        data = pd.concat([first, second[[c for c, _ in self.columns]]], ignore_index=True)
+        if self.unique:
+            data = data.drop_duplicates(list(self.unique), keep="last")
+        return data.reset_index(drop=True)
+
+    def append(self, df):
+        self._data = self._combine(self.data, df)
@@ -1,19 +1,61 @@
 import sys
 import argparse
 
+from pipeline import Pipeline
 from pipeline.batch import get_pipeline_status
+from pipeline.daemon import DaemonClient, daemon_running
 
 parser = argparse.ArgumentParser('Check status of pipeline')
 parser.add_argument('name', help='yaml file basename')
 parser.add_argument('--all', action='store_true')
+parser.add_argument('--cancel', action='store_true', help='cancel pipeline running in the daemon')
+parser.add_argument('--resume', action='store_true', help='resume pipeline in the daemon')
+parser.add_argument('--efficiency', action='store_true',
+                    help='record sacct accounting and report CPU/memory efficiency by stage and filter')
+parser.add_argument('--stragglers', action='store_true',
+                    help='record per-dataId runtimes from job logs and list persistent stragglers')
+parser.add_argument('--socket', default=None, help='daemon socket path')
 
 args = parser.parse_args()
 
+if args.efficiency:
+    pipe = Pipeline(args.name + '.yaml')
+    n = pipe.accounting.ingest_pipeline(pipe)
+    if n:
+        pipe.accounting.save()
+    print(pipe.accounting.efficiency(pipeline=None if args.all else pipe.name))
+    sys.exit()
+
+if args.stragglers:
+    pipe = Pipeline(args.name + '.yaml')
+    if pipe.runtimes.ingest_pipeline(pipe):
+        pipe.runtimes.save()
+    print(pipe.runtimes.stragglers())
+    sys.exit()
+
+if daemon_running(args.socket):
+    client = DaemonClient(args.socket)
+    try:
+        if args.cancel:
+            print('Cancelled jobs: {0}'.format(client.cancel(args.name)))
+        elif args.resume:
+            print('{0} resumed.'.format(client.resume(args.name)))
+        for run in client.status(args.name):
+            counts = ', '.join(['{0} {1}'.format(n, s) for s, n in sorted(run['counts'].items())])
+            print('{0[name]}: {0[state]} ({1})'.format(run, counts))
+            if run['error']:
+                print('  {0}'.format(run['error']))
+            for key in sorted(run['jobs']):
+                print('  {0:<30} {1[jobid]:>10} {1[status]}'.format(key, run['jobs'][key]))
+        sys.exit()
+    except RuntimeError as e:
+        if args.cancel or args.resume:
+            sys.exit(str(e))
+        # Not known to the daemon; fall back to sacct.
+
 status = get_pipeline_status(args.name)
 
 if args.all:
     print(status)
 else:
     print(status[-1])
-
-    
\ No newline at end of file
@@ -0,0 +1,13 @@
+import argparse
+import logging
+
+from pipeline.daemon import PipelineDaemon
+
+parser = argparse.ArgumentParser('Run the pipeline daemon')
+parser.add_argument('--socket', default=None, help='socket path (default ~/.pipeline/daemon.sock)')
+parser.add_argument('--poll', type=float, default=10, help='seconds between slurm status queries')
+
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.INFO)
+PipelineDaemon(socket_path=args.socket, poll_interval=args.poll).serve_forever()
@@ -2,11 +2,20 @@ import sys
 import argparse
 
 from pipeline import Pipeline
+from pipeline.daemon import DaemonClient, daemon_running
 
 parser = argparse.ArgumentParser('Run a pipeline')
 parser.add_argument('configfile', help='yaml file')
 parser.add_argument('--test', action='store_true')
 parser.add_argument('--serial', action='store_true')
+parser.add_argument('--clobber', action='store_true')
+parser.add_argument('--resume', action='store_true',
+                    help='adopt completed/queued jobs from the last run instead of resubmitting')
+parser.add_argument('--auto-resources', action='store_true',
+                    help='size memory and tasks-per-node from slurm accounting of earlier runs')
+parser.add_argument('--daemon', action='store_true',
+                    help='hand the pipeline to a running pipelineDaemon.py and return immediately')
+parser.add_argument('--socket', default=None, help='daemon socket path')
 
 args = parser.parse_args()
 
@@ -15,6 +24,13 @@ if not args.configfile.endswith('.yaml'):
 else:
     file = args.configfile
 
-pipe = Pipeline(file)
-pipe.run(test=args.test, parallel=not args.serial)
-
+if args.daemon:
+    if not daemon_running(args.socket):
+        sys.exit('No pipeline daemon running; start one with pipelineDaemon.py')
+    name = DaemonClient(args.socket).submit(file, test=args.test, clobber=args.clobber, resume=args.resume,
+                                            auto_resources=args.auto_resources or None)
+    print('{0} submitted to daemon.'.format(name))
+else:
+    pipe = Pipeline(file)
+    pipe.run(test=args.test, parallel=not args.serial, clobber=args.clobber, resume=args.resume,
+             auto_resources=args.auto_resources or None)
@@ -14,8 +14,10 @@ setup(name = "pipeline",
     author_email = "tdm@astro.princeton.edu",
     url = "https://github.com/timothydmorton/lsst-utils/pipeline",
     packages = find_packages(),
-    scripts = ['scripts/runPipeline.py', 'scripts/checkPipeline.py'],
+    scripts = ['scripts/runPipeline.py', 'scripts/checkPipeline.py',
+               'scripts/pipelineDaemon.py'],
     package_data = {'pipeline': ['fields/*']},
+    extras_require = {'inotify': ['inotify_simple']},
     classifiers=[
       'Development Status :: 3 - Alpha',
       'Intended Audience :: Science/Research',
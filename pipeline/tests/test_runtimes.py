@@ -0,0 +1,67 @@
+"""Runtime ingestion from driver logs named as ctrl_pool writes them."""
+import os
+
+import pytest
+
+pytest.importorskip("lsst.daf.persistence")
+
+from pipeline.runtimes import RuntimeHistory, find_job_log
+
+JOBNAME = "me-T1-singleFrameDriver-HSC-G"
+JOBID = 1234
+
+# --longlog lines as singleFrameDriver writes them through ctrl_pool's logOperation
+LOG = """\
+INFO  2026-10-19T10:00:00.000+0000 singleFrameDriver ()(pool.py:1122)- node01:4321: Start processing {'visit': 1228, 'ccd': 49, 'filter': 'HSC-G'}
+INFO  2026-10-19T10:00:01.500+0000 singleFrameDriver.processCcd.isr ()(isrTask.py:838)- Applying linearity corrections
+INFO  2026-10-19T10:02:00.000+0000 singleFrameDriver ()(pool.py:1122)- node01:4321: Finished processing {'visit': 1228, 'ccd': 49, 'filter': 'HSC-G'}
+INFO  2026-10-19T10:00:00.000+0000 singleFrameDriver ()(pool.py:1122)- node02:999: Start processing {'visit': 1228, 'ccd': 50, 'filter': 'HSC-G'}
+INFO  2026-10-19T10:10:00.000+0000 singleFrameDriver ()(pool.py:1122)- node02:999: Finished processing {'visit': 1228, 'ccd': 50, 'filter': 'HSC-G'}
+"""
+
+
+class FakeSentinels(object):
+    def state(self, jobid):
+        return "COMPLETED" if jobid == JOBID else None
+
+
+class FakePipeline(object):
+    name = "t"
+    sentinels = FakeSentinels()
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.logfile = os.path.join(output_dir, "pipe.log")
+
+    def units(self):
+        return {JOBNAME: ("singleFrameDriver", "HSC-G", None)}
+
+
+@pytest.fixture
+def pipe(tmpdir):
+    output_dir = str(tmpdir)
+    with open(os.path.join(output_dir, "pipe.log"), "w") as fout:
+        fout.write("=" * 30 + "\n2026-10-19 10:00:00\nuser: me\n" + "=" * 30 + "\n")
+        fout.write("{0} {1}\n".format(JOBNAME, JOBID))
+    with open(os.path.join(output_dir, "{0}.o{1}".format(JOBNAME, JOBID)), "w") as fout:
+        fout.write(LOG)
+    return FakePipeline(output_dir)
+
+
+def test_find_job_log(pipe):
+    assert find_job_log(pipe.output_dir, JOBNAME, JOBID).endswith(".o1234")
+    assert find_job_log(pipe.output_dir, JOBNAME, JOBID + 1) is None
+
+
+def test_ingest_driver_log(pipe, tmpdir):
+    history = RuntimeHistory(str(tmpdir.join("runtimes.npz")))
+    assert history.ingest_pipeline(pipe) == 2
+
+    df = history.data.sort_values("ccd")
+    assert list(df.ccd) == [49, 50]
+    assert list(df.duration) == [120.0, 600.0]
+    assert set(df.stage) == {"singleFrameDriver"}
+    assert set(df.jobid) == {JOBID}
+
+    # Already recorded
+    assert history.ingest_pipeline(pipe) == 0